@@ -1,4 +1,9 @@
+from state import *
+from layout import *
 from computation import *
+from serializers import *
 from runner import *
 from util import *
+from executor import *
+from compiled import *
 from test import *
\ No newline at end of file
@@ -0,0 +1,138 @@
+'''
+PyCE: Computational experiment management framework.
+
+Framework overhead benchmarks
+Copyright 2010, Konstantin Tretyakov.
+Licensed under the BSD (3-clause) license.
+'''
+
+'''
+Measures the time pyce itself spends on synthetic schemes with no-op computations:
+    $ python -m pyce.benchmark [options] [shape[:size] ...]
+Shapes:
+    chain   - saved._chain[i] depends on saved._chain[i-1]
+    fan     - one source, size targets depending on it, one target depending on all of them
+    lattice - a size x size grid (cell i*size + j), each cell depends on its upper and left neighbours
+    sweep   - size independent targets and one target depending on all of them
+For each scheme the following are timed: construction, find_next_step_to, the list and stat actions,
+save_makefile and, for schemes of at most --dispatch-limit targets, computing all targets with
+run_to_target (reported also per target). The results are printed as a JSON list, one object per scheme.
+'''
+
+import sys, time, json, shutil, tempfile, optparse, resource
+from computation import ComputationScheme
+from runner import PythonFunctionRunner
+from util import print_target_list, print_target_list_with_stats
+from executor import run_to_target
+
+DEFAULT_CASES = ['chain:10000', 'fan:10000', 'lattice:100', 'sweep:1000000']
+
+def noop(*args, **kw):
+    return None
+
+def make_chain(scheme, size):
+    saved, run = scheme.data_object, scheme.computation
+    saved._chain[0] = run.pyce.benchmark.noop(0)
+    for i in xrange(1, size):
+        saved._chain[i] = run.pyce.benchmark.noop(saved._chain[i-1])
+    return saved._chain[size-1]
+
+def make_fan(scheme, size):
+    saved, run = scheme.data_object, scheme.computation
+    saved._source = run.pyce.benchmark.noop(0)
+    for i in xrange(size):
+        saved._fan[i] = run.pyce.benchmark.noop(saved._source, i)
+    saved._sink = run.pyce.benchmark.noop([saved._fan[i] for i in xrange(size)])
+    return saved._sink
+
+def make_lattice(scheme, size):
+    saved, run = scheme.data_object, scheme.computation
+    for i in xrange(size):
+        for j in xrange(size):
+            deps = []
+            if i > 0:
+                deps.append(saved._cell[(i-1)*size + j])
+            if j > 0:
+                deps.append(saved._cell[i*size + j-1])
+            saved._cell[i*size + j] = run.pyce.benchmark.noop(i, j, *deps)
+    return saved._cell[size*size - 1]
+
+def make_sweep(scheme, size):
+    saved, run = scheme.data_object, scheme.computation
+    for i in xrange(size):
+        saved._point[i] = run.pyce.benchmark.noop(i)
+    saved._sweep = run.pyce.benchmark.noop([saved._point[i] for i in xrange(size)])
+    return saved._sweep
+
+GENERATORS = dict(chain=make_chain, fan=make_fan, lattice=make_lattice, sweep=make_sweep)
+
+class NullOutput:
+    def write(self, s):
+        pass
+    def flush(self):
+        pass
+
+def timed(fn, *args, **kw):
+    '''
+    Calls fn with everything it prints discarded, returns the elapsed time in seconds.
+    '''
+    stdout = sys.stdout
+    sys.stdout = NullOutput()
+    try:
+        start = time.time()
+        fn(*args, **kw)
+        return time.time() - start
+    finally:
+        sys.stdout = stdout
+
+def run_case(shape, size, dispatch_limit=5000, jobs=1):
+    '''
+    Benchmarks one scheme, returns a dict with the results.
+    '''
+    cache_dir = tempfile.mkdtemp(prefix='pyce-benchmark-')
+    try:
+        result = dict(shape=shape, size=size)
+        scheme = ComputationScheme(cache_dir)
+        holder = []
+        result['build'] = timed(lambda: holder.append(str(GENERATORS[shape](scheme, size))))
+        final = holder[0]
+        result['targets'] = len(scheme.dependency_graph)
+        result['maxrss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result['find_next_step_to'] = timed(scheme.find_next_step_to, final)
+        result['list'] = timed(print_target_list, scheme)
+        result['stat'] = timed(print_target_list_with_stats, scheme)
+        result['save_makefile'] = timed(scheme.save_makefile, 'python experiment.py compute', NullOutput())
+        if result['targets'] <= dispatch_limit:
+            runner = PythonFunctionRunner()
+            result['run'] = timed(run_to_target, scheme, runner, final, jobs)
+            result['run_per_target'] = result['run'] / result['targets']
+            result['run_jobs'] = jobs
+        else:
+            result['run'] = result['run_per_target'] = None
+        return result
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [shape[:size] ...]",
+                                   description="Shapes: %s. Default: %s" % (", ".join(sorted(GENERATORS)), " ".join(DEFAULT_CASES)))
+    parser.add_option("-o", "--output", dest="output", default=None, help="write the results to a file instead of stdout")
+    parser.add_option("-d", "--dispatch-limit", type="int", dest="dispatch_limit", default=5000,
+                      help="time run_to_target only for schemes with at most this many targets")
+    parser.add_option("-j", "--jobs", type="int", dest="jobs", default=1, help="number of parallel computations for run_to_target")
+    (options, args) = parser.parse_args()
+    results = []
+    for case in (args if len(args) > 0 else DEFAULT_CASES):
+        (shape, _, size) = case.partition(':')
+        if shape not in GENERATORS:
+            parser.error("Unknown shape: %s" % shape)
+        results.append(run_case(shape, int(size) if size else 1000, options.dispatch_limit, options.jobs))
+        print >>sys.stderr, "Done: %s" % case
+    out = open(options.output, 'w') if options.output is not None else sys.stdout
+    json.dump(results, out, indent=1, sort_keys=True)
+    out.write("\n")
+    if out is not sys.stdout:
+        out.close()
+
+if __name__ == "__main__":
+    main()
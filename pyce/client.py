@@ -0,0 +1,88 @@
+'''
+PyCE: Computational experiment management framework.
+
+Fork-server client
+Copyright 2010, Konstantin Tretyakov.
+Licensed under the BSD (3-clause) license.
+'''
+
+'''
+Asks a running fork-server (see server.py and the "serve" action) to compute a target:
+    $ python client.py <socket> <target>
+The output of the computation is printed, and the exit code is 0 only if the computation succeeded.
+This module intentionally imports nothing but the standard library, so that it starts fast
+when invoked from Makefile rules (see the --socket option of the "makefile" action).
+
+The server answers with messages, each one a type byte and the length of the data (4 bytes,
+big-endian) followed by the data: any number of MESSAGE_OUTPUT messages with the output of
+the computation, then a MESSAGE_RESULT message with the result code.
+'''
+
+import sys, socket, struct
+
+MESSAGE_OUTPUT = 'O'
+MESSAGE_RESULT = 'R'
+MESSAGE_HEADER = struct.Struct('>cI')
+
+def send_message(s, kind, data):
+    s.sendall(MESSAGE_HEADER.pack(kind, len(data)) + data)
+
+def receive_exactly(s, size):
+    '''
+    Receives size bytes. Returns None if the connection is closed before the first one.
+    '''
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        data = s.recv(min(remaining, 65536))
+        if not data:
+            if remaining == size:
+                return None
+            raise Exception("Connection closed in the middle of a message")
+        chunks.append(data)
+        remaining = remaining - len(data)
+    return "".join(chunks)
+
+def receive_message(s):
+    '''
+    Returns (kind, data) of the next message, or (None, None) if the connection is closed.
+    '''
+    header = receive_exactly(s, MESSAGE_HEADER.size)
+    if header is None:
+        return (None, None)
+    (kind, size) = MESSAGE_HEADER.unpack(header)
+    data = receive_exactly(s, size) if size > 0 else ""
+    if data is None:
+        raise Exception("Connection closed in the middle of a message")
+    return (kind, data)
+
+def request_compute(socket_path, target_str, output=sys.stdout):
+    '''
+    Sends the request, copies the output of the computation to output and returns
+    the result code of compute_target (see util.py).
+    '''
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(socket_path)
+    try:
+        s.sendall(target_str + "\n")
+        result = None
+        while True:
+            (kind, data) = receive_message(s)
+            if kind is None:
+                break
+            elif kind == MESSAGE_OUTPUT:
+                output.write(data)
+                output.flush()
+            elif kind == MESSAGE_RESULT:
+                result = int(data)
+    finally:
+        s.close()
+    if result is None:
+        raise Exception("The server did not report a result for %s" % target_str)
+    return result
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print "Usage: %s <socket> <target>" % sys.argv[0]
+        sys.exit(2)
+    sys.exit(0 if request_compute(sys.argv[1], sys.argv[2]) == 0 else 1)
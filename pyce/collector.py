@@ -0,0 +1,320 @@
+'''
+PyCE: Computational experiment management framework.
+
+Garbage collection of intermediate results
+Copyright 2010, Konstantin Tretyakov.
+Licensed under the BSD (3-clause) license.
+'''
+
+'''
+Intermediate targets (those some other target depends on) are usually not needed any more once all
+the targets depending on them are done. The "gc" action removes their outputs, or with --compress
+replaces them with gzip-compressed copies. With --quota, only as many outputs are collected as needed
+to bring the size of the cache directory under the quota: first those of the intermediates whose
+dependents are all done, then of the other intermediates, least recently used first. The "run" action
+collects in the same way while computing, if given --quota or --collect. Only the computations of such
+a run mark the outputs they use (see use_dependencies), otherwise the access times kept by the file
+system tell which were used last. Outputs read by running computations (of locked targets) are never collected.
+
+The following targets are never collected:
+* the main target of the scheme (see ComputationScheme.set_main_target) and the target given to the action,
+* targets computed with the _pin=True keyword argument, e.g. saved.model = run.mod.train(saved.data, _pin=True),
+* targets given with the --pin option,
+* targets nothing depends on.
+A removed target is simply not done any more, so it is recomputed whenever it is needed again.
+A compressed target stays done. Its output is restored when a computation needs it (see use_dependencies).
+A Makefile saved with --collect (see save_makefile) treats collected outputs as intermediate files: make
+recomputes them only when a target depending on them has to be recomputed. Other Makefiles and ninja build
+files recompute them (see save_ninja).
+'''
+
+import os, time, gzip, shutil
+from collections import OrderedDict
+from state import TARGET_STATUS_DONE, TARGET_STATUS_LOCKED, COMPRESSED_SUFFIX
+
+SIZE_UNITS = dict(K=1 << 10, M=1 << 20, G=1 << 30, T=1 << 40)
+
+def parse_size(s):
+    '''
+    Converts a size such as 500M, 1.5G or 1000000 (bytes) to the number of bytes.
+    '''
+    s = s.strip().upper().rstrip('B')
+    multiplier = 1
+    if len(s) > 0 and s[-1] in SIZE_UNITS:
+        multiplier = SIZE_UNITS[s[-1]]
+        s = s[:-1]
+    try:
+        return int(float(s) * multiplier)
+    except ValueError:
+        raise Exception("Invalid size: %s" % s)
+
+def pinned_targets(scheme, extra=[]):
+    '''
+    Returns the set of targets which must not be collected: the main target, those computed
+    with _pin=True and the extra ones.
+    '''
+    result = set(extra)
+    if scheme.main_target is not None:
+        result.add(str(scheme.main_target))
+    for (obj, comp) in scheme.iter_invocations():
+        if comp.special_kwarg('_pin', False):
+            result.add(str(obj))
+    return result
+
+def dependent_targets(scheme):
+    '''
+    Returns a dict mapping each target to the list of targets depending on it.
+    '''
+    result = dict()
+    for t in scheme.iter_targets():
+        for d in scheme.get_dependencies(t) or []:
+            result.setdefault(d, []).append(t)
+    return result
+
+def output_size(scheme, target_str):
+    '''
+    Returns the size of the output of the target (compressed or not), 0 if there is none.
+    '''
+    filename = scheme.target_filename(target_str)
+    for f in [filename, filename + COMPRESSED_SUFFIX]:
+        try:
+            return os.path.getsize(f)
+        except OSError:
+            pass
+    return 0
+
+def cache_size(scheme):
+    '''
+    Returns the total size of the files in the cache directory.
+    '''
+    result = 0
+    for name in scheme.layout.list_cache(scheme.cache_dir):
+        try:
+            result = result + os.path.getsize(os.path.join(scheme.cache_dir, name))
+        except OSError:
+            pass    # Removed meanwhile
+    return result
+
+def last_use(scheme, target_str):
+    '''
+    Returns the time the output of the target was last used (see use_dependencies) or written.
+    '''
+    filename = scheme.target_filename(target_str)
+    for f in [filename, filename + COMPRESSED_SUFFIX]:
+        try:
+            st = os.stat(f)
+            return max(st.st_atime, st.st_mtime)
+        except OSError:
+            pass
+    return 0
+
+def copy_file(source, destination, open_source=open, open_destination=open):
+    '''
+    Copies source to destination through a temporary file and a rename, keeping the modification time.
+    '''
+    mtime = os.stat(source).st_mtime
+    tmp_filename = "%s.%d.tmp" % (destination, os.getpid())
+    fin = open_source(source, 'rb')
+    try:
+        fout = open_destination(tmp_filename, 'wb')
+        try:
+            shutil.copyfileobj(fin, fout, 1 << 20)
+        finally:
+            fout.close()
+    finally:
+        fin.close()
+    os.utime(tmp_filename, (time.time(), mtime))
+    os.rename(tmp_filename, destination)
+
+def compress_output(scheme, target_str):
+    '''
+    Replaces the output of the target with its compressed copy (<output>.pyce-gz). Returns the number of bytes saved.
+    '''
+    filename = scheme.target_filename(target_str)
+    if not os.path.isfile(filename):
+        return 0
+    size = os.path.getsize(filename)
+    copy_file(filename, filename + COMPRESSED_SUFFIX, open_destination=gzip.open)
+    os.unlink(filename)
+    return size - os.path.getsize(filename + COMPRESSED_SUFFIX)
+
+def restore_output(scheme, target_str):
+    '''
+    Restores the output of the target from its compressed copy, if there is one. Returns True if it was restored.
+    Several processes may restore the same output at the same time.
+    '''
+    filename = scheme.target_filename(target_str)
+    if os.path.exists(filename) or not os.path.exists(filename + COMPRESSED_SUFFIX):
+        return False
+    try:
+        copy_file(filename + COMPRESSED_SUFFIX, filename, open_source=gzip.open)
+    except (IOError, OSError):
+        if not os.path.exists(filename):
+            raise
+        return False    # Restored by another process
+    try:
+        os.unlink(filename + COMPRESSED_SUFFIX)
+    except OSError:
+        pass
+    return True
+
+def use_dependencies(scheme, target_str):
+    '''
+    Restores the compressed outputs of the dependencies of the target. If the scheme tracks the use of
+    outputs (scheme.track_use, set by GarbageCollector), also marks them as used now (by the access time),
+    for the least recently used order of the collection.
+    Also removes the compressed output of the target itself, which is about to be recomputed.
+    Called before each computation.
+    '''
+    if os.path.exists(scheme.target_filename(target_str) + COMPRESSED_SUFFIX):
+        os.unlink(scheme.target_filename(target_str) + COMPRESSED_SUFFIX)
+    now = time.time() if scheme.track_use else None
+    for d in scheme.get_dependencies(target_str) or []:
+        filename = scheme.target_filename(d)
+        try:
+            mtime = os.stat(filename).st_mtime
+        except OSError:
+            if restore_output(scheme, d):
+                print "Restored compressed output: %s" % d
+            if now is None:
+                continue
+            try:
+                mtime = os.stat(filename).st_mtime
+            except OSError:
+                continue    # Kept in memory by the runner, or not a file at all
+        if now is not None:
+            try:
+                os.utime(filename, (now, mtime))
+            except OSError:
+                pass
+
+def remove_output(scheme, target_str):
+    '''
+    Removes the output of the target, compressed or not. Returns the number of bytes freed.
+    '''
+    size = output_size(scheme, target_str)
+    scheme.remove_target(target_str)
+    return size
+
+def collect_output(scheme, target_str, compress=False):
+    '''
+    Removes or compresses the output of the target. Returns the number of bytes freed.
+    '''
+    if compress:
+        print "Compressed intermediate output: %s" % target_str
+        return compress_output(scheme, target_str)
+    print "Removed intermediate output: %s" % target_str
+    return remove_output(scheme, target_str)
+
+class GarbageCollector:
+    '''
+    Collects the outputs of intermediate targets during a computation (see run_to_target).
+    The driver reports each completed target with completed() and each target whose dependents
+    (needed by the computation) are all done with consumed(). Without a quota, consumed targets
+    are collected at once, otherwise they are collected only while the cache is over the quota,
+    least recently consumed first.
+    quota - size limit of the cache directory in bytes, or None
+    compress - compress the outputs instead of removing them
+    pinned - targets never to be collected (see pinned_targets)
+    runner - the computation runner, whose result kept in memory (see ResultStore) is dropped
+             before a target is collected, so that it is not written back later
+    '''
+    def __init__(self, scheme, quota=None, compress=False, pinned=(), runner=None):
+        self.scheme = scheme
+        scheme.track_use = True
+        self.release_result = getattr(runner, 'release_result', None)
+        self.quota = quota
+        self.compress = compress
+        self.pinned = pinned_targets(scheme, pinned)
+        self.dependents = dependent_targets(scheme)
+        self.size = cache_size(scheme) if quota is not None else 0
+        self.candidates = OrderedDict()
+
+    def collect(self, target_str):
+        if self.release_result is not None:
+            self.release_result(target_str)
+        self.size = self.size - collect_output(self.scheme, target_str, self.compress)
+
+    def completed(self, target_str):
+        if self.quota is not None:
+            self.size = self.size + output_size(self.scheme, target_str)
+            self.shrink()
+
+    def consumed(self, target_str, completed=()):
+        '''
+        Reports that the targets depending on target_str needed by the computation are done.
+        completed - targets known to be done, the others are looked up.
+        '''
+        if target_str in self.pinned or len(self.dependents.get(target_str, [])) == 0:
+            return
+        for d in self.dependents[target_str]:
+            if d not in completed and not self.scheme.is_done(d):
+                return    # Needed by a target outside of the computation
+        if self.quota is None:
+            self.collect(target_str)
+        else:
+            self.candidates[target_str] = True
+            self.shrink()
+
+    def shrink(self):
+        while self.size > self.quota and len(self.candidates) > 0:
+            self.collect(self.candidates.popitem(last=False)[0])
+
+def collect_garbage(scheme, target_str=None, quota=None, compress=False, pinned=()):
+    '''
+    Collects the outputs of the intermediate targets (needed for target_str, or of all targets), see above.
+    Returns the list of the collected targets.
+    '''
+    pinned = pinned_targets(scheme, pinned)
+    if target_str is not None:
+        pinned.add(target_str)
+        scope = set([target_str])
+        stack = [target_str]
+        while len(stack) > 0:
+            for d in scheme.get_dependencies(stack.pop()) or []:
+                if d not in scope:
+                    scope.add(d)
+                    stack.append(d)
+    else:
+        scope = None
+    dependents = dependent_targets(scheme)
+    snapshot = scheme.status_snapshot()
+    consumed = []
+    others = []
+    for (t, deps) in dependents.iteritems():
+        if t in pinned or (scope is not None and t not in scope) or snapshot.target_status(t) != TARGET_STATUS_DONE:
+            continue
+        if compress and not os.path.isfile(scheme.target_filename(t)):
+            continue    # Compressed already
+        statuses = [snapshot.target_status(d) for d in deps]
+        if TARGET_STATUS_LOCKED in statuses:
+            continue    # Read by a running computation
+        if len([s for s in statuses if s != TARGET_STATUS_DONE]) == 0:
+            consumed.append(t)
+        else:
+            others.append(t)
+
+    if quota is None:
+        victims = consumed
+    else:
+        victims = sorted(consumed, key=lambda t: last_use(scheme, t)) + sorted(others, key=lambda t: last_use(scheme, t))
+    size = cache_size(scheme) if quota is not None else 0
+    collected = []
+    for t in victims:
+        if quota is not None and size <= quota:
+            break
+        if not scheme.lock_target(t):
+            print "Target locked, not collected: %s" % t
+            continue
+        try:
+            # A dependent may have been started since the snapshot was taken
+            if len([d for d in dependents[t] if scheme.is_locked(d)]) > 0:
+                print "Target in use, not collected: %s" % t
+                continue
+            size = size - collect_output(scheme, t, compress)
+            collected.append(t)
+        finally:
+            scheme.unlock_target(t)
+    if quota is not None:
+        print "Cache size: %d bytes (quota %d bytes)" % (size, quota)
+    return collected
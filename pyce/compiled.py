@@ -0,0 +1,142 @@
+'''
+PyCE: Computational experiment management framework.
+
+Compiled scheme cache
+Copyright 2010, Konstantin Tretyakov.
+Licensed under the BSD (3-clause) license.
+'''
+
+'''
+A built ComputationScheme can be saved to a file and loaded back instead of re-running
+the experiment definition. The file consists of a header line, the pickled invocations
+(each one pickled separately) and the pickled "index" with the dependency graph and the
+offsets of the invocations. On loading, the file is memory-mapped, only the index is decoded,
+and each invocation is unpickled when it is accessed.
+'''
+
+import os, mmap, hashlib, inspect, cPickle
+from array import array
+from computation import ComputationScheme
+
+COMPILED_SCHEME_FORMAT = "PYCE-SCHEME 2\n"
+
+class LazyInvocationList(object):
+    '''
+    Read-only list of the (data object, computation) pairs of a compiled scheme.
+    Elements are unpickled from the memory-mapped file on access.
+    '''
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i = i + len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return cPickle.loads(self.data[self.offsets[i]:self.offsets[i+1]])
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def append(self, invocation):
+        raise Exception("A compiled scheme can not be extended")
+
+def settings_key(obj):
+    '''
+    Describes a state store or layout by its class and its simple-valued attributes.
+    '''
+    if obj is None:
+        return 'None'
+    attributes = [(k, v) for (k, v) in sorted(vars(obj).iteritems()) if isinstance(v, (bool, int, long, float, str, unicode))]
+    return '%s.%s%r' % (obj.__class__.__module__, obj.__class__.__name__, attributes)
+
+def compiled_scheme_prefix(cache_dir, definition_function):
+    '''
+    Returns the common start of the names of the compiled scheme files of the given experiment definition.
+    '''
+    module = os.path.splitext(os.path.basename(inspect.getsourcefile(definition_function)))[0]
+    return os.path.join(cache_dir, '.pyce-scheme-%s.%s-' % (module, definition_function.__name__))
+
+def compiled_scheme_filename(cache_dir, definition_function, version, state_store=None, share_computations=False, layout=None):
+    '''
+    Returns the name of the compiled scheme file for the given experiment definition.
+    The name depends on the source of the module containing the definition, the version
+    string and the settings of the scheme (the remaining parameters of the ComputationScheme
+    constructor), so that changing any of them makes the old file unused.
+    '''
+    h = hashlib.sha1(COMPILED_SCHEME_FORMAT)
+    h.update(version)
+    h.update("\n%r\n%s\n%s\n" % (share_computations, settings_key(state_store), settings_key(layout)))
+    f = open(inspect.getsourcefile(definition_function), 'rb')
+    h.update(f.read())
+    f.close()
+    return compiled_scheme_prefix(cache_dir, definition_function) + h.hexdigest()
+
+def remove_superseded_schemes(cache_dir, definition_function, filename):
+    '''
+    Removes the compiled scheme files of the given experiment definition other than filename.
+    '''
+    prefix = compiled_scheme_prefix(cache_dir, definition_function)
+    for name in os.listdir(cache_dir):
+        other = os.path.join(cache_dir, name)
+        if other.startswith(prefix) and other != filename and not other.endswith('.tmp'):
+            try:
+                os.unlink(other)
+            except OSError:
+                pass    # Removed by another process
+
+def save_compiled_scheme(scheme, filename):
+    '''
+    Saves the scheme to the given file. Schemes with rules (see add_rule) can not be saved,
+    as the rules are arbitrary functions. The file is written under a temporary name and renamed.
+    '''
+    if len(scheme.rules) > 0:
+        raise Exception("Schemes with rules can not be compiled")
+    tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+    f = open(tmp_filename, 'wb')
+    try:
+        f.write(COMPILED_SCHEME_FORMAT)
+        offsets = array('l', [f.tell()])
+        for inv in scheme.all_invocations:
+            f.write(cPickle.dumps(inv, cPickle.HIGHEST_PROTOCOL))
+            offsets.append(f.tell())
+        index_start = f.tell()
+        index = dict(dependency_graph=scheme.dependency_graph, main_target=scheme.main_target,
+                     equivalent_targets=scheme.equivalent_targets, offsets=offsets.tostring())
+        cPickle.dump(index, f, cPickle.HIGHEST_PROTOCOL)
+        # The index is found through its position, stored in the last line
+        f.write("\n%d\n" % index_start)
+    finally:
+        f.close()
+    os.rename(tmp_filename, filename)
+
+def load_compiled_scheme(filename, cache_dir='.', state_store=None, share_computations=False, layout=None):
+    '''
+    Loads a scheme saved by save_compiled_scheme. The remaining parameters are those of the
+    ComputationScheme constructor, they are not stored in the file.
+    '''
+    f = open(filename, 'rb')
+    try:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    if data[:len(COMPILED_SCHEME_FORMAT)] != COMPILED_SCHEME_FORMAT:
+        raise Exception("%s is not a compiled scheme" % filename)
+    tail = data.rfind("\n", 0, len(data) - 1)
+    index_start = int(data[tail+1:])
+    index = cPickle.loads(data[index_start:tail])
+    offsets = array('l')
+    offsets.fromstring(index['offsets'])
+
+    scheme = ComputationScheme(cache_dir, state_store, share_computations, layout)
+    scheme.dependency_graph = index['dependency_graph']
+    scheme.invocation_idx.graph = scheme.dependency_graph
+    scheme.all_invocations = LazyInvocationList(data, offsets)
+    scheme.main_target = index['main_target']
+    scheme.equivalent_targets = index['equivalent_targets']
+    return scheme
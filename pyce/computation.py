@@ -21,125 +21,747 @@ Example:
     # dependencies among the "saved.*" objects
 '''
 
-from urllib import quote
-import os, sys
+import os, sys, shutil
+from array import array
+from itertools import izip, count
+from collections import OrderedDict
+from state import *
+from layout import *
 
 class ComputationScheme:
-    def __init__(self, cache_dir = '.'):
+    def __init__(self, cache_dir = '.', state_store = None, share_computations = False, layout = None):
         '''
         cache_dir - directory for storing computed files
+        state_store - object that keeps track of locked targets, FileStateStore() by default
+        share_computations - if True, targets with identical computations are computed only once,
+                             the others receive hard links to the same output (see find_equivalent_targets)
+        layout - placement of the files in cache_dir, FlatLayout() by default (see also ShardedLayout)
         '''
+        self.state_store = state_store if state_store is not None else FileStateStore()
+        self.layout = layout if layout is not None else FlatLayout()
+        self.share_computations = share_computations
         self.all_invocations = []
-        self.invocation_idx = dict()
-        self.dependency_graph = dict()
+        self.dependency_graph = DependencyGraph()
+        self.invocation_idx = InvocationIndex(self.dependency_graph)
+        self.equivalent_targets = dict()
+        self.rules = dict()
         self.cache_dir = cache_dir
         self.data_object = DataObjectDescriptor(scheme=self)
         self.computation = ComputationDescriptor()
         self.main_target = None
+        self.track_use = False     # Whether computations mark their inputs as used, see collector.use_dependencies
 
     def target_exists(self, target_str):
-        return target_str in self.invocation_idx
+        return target_str in self.invocation_idx or self.find_rule_invocation(target_str) is not None
 
     def add_invocation(self, data_object, computation):
         target = str(data_object)
-        if self.dependency_graph.get(target, None) is not None:
+        if target in self.dependency_graph:
             raise Exception("Target %s has multiple specifications" % target)
 
-        if not isinstance(computation, ComputationDescriptor):
-            computation = ComputationDescriptor(name='copy', args=[computation])
+        computation = as_computation(computation)
 
-        self.all_invocations.append( (data_object, computation) )
         deps = map(str, computation.dependencies())
+        self.dependency_graph.add(target, deps)
+        self.all_invocations.append( (data_object, computation) )
+        if self.share_computations:
+            key = self.computation_key(target, computation)
+            if key is not None:
+                self.equivalent_targets.setdefault(key, []).append(target)
+
+    def computation_key(self, target_str, computation):
+        '''
+        Two targets are equivalent if their computations have the same canonical key and either both
+        or none of them start with _ (runners treat the outputs of those targets differently).
+        Returns None for computations with arguments which can not be compared faithfully (see canonical_key),
+        such targets are never equivalent to others.
+        '''
+        key = computation.canonical_key()
+        return (target_str.startswith('_'), key) if key is not None else None
+
+    def find_equivalent_targets(self, target_str):
+        '''
+        Returns the list of other targets with exactly the same computation as target_str.
+        Always empty unless share_computations is on.
+        '''
+        if not self.share_computations or not self.target_exists(target_str):
+            return []
+        (obj, comp) = self.find_invocation_for_target(target_str)
+        key = self.computation_key(target_str, comp)
+        if key is None:
+            return []
+        return [t for t in self.equivalent_targets.get(key, []) if t != target_str]
 
-        self.dependency_graph[target] = deps
-        self.invocation_idx[target] = len(self.all_invocations) - 1
+    def share_output(self, source_str, target_str):
+        '''
+        Makes the output of source_str also the output of target_str, by a hard link when possible.
+        The output of target_str is kept if source_str has no output file (e.g. a compressed one, see collector.py).
+        '''
+        if not os.path.isfile(self.target_filename(source_str)):
+            raise Exception("No output file to share: %s" % source_str)
+        self.remove_target(target_str)
+        try:
+            os.link(self.target_filename(source_str), self.target_filename(target_str))
+        except OSError:
+            shutil.copyfile(self.target_filename(source_str), self.target_filename(target_str))
+
+    def add_rule(self, family, indices, rule):
+        '''
+        Declares a whole indexed family of targets at once, e.g.
+            scheme.add_rule(saved.data, xrange(1, 1000000), lambda i: run.f(saved.data[i-1], i))
+        is equivalent to
+            for i in xrange(1, 1000000):
+                saved.data[i] = run.f(saved.data[i-1], i)
+        but nothing is created in advance: the computation of a target (and thus its dependencies) is
+        obtained by calling rule(i) when the target is looked up. The results for the last
+        TargetRule.CACHE_SIZE indices looked up are kept, so rule must always return the same computation for an index.
+        family - a data object without an index (saved.data)
+        indices - an xrange or any other container of indices; xranges allow constant-time lookups
+        rule - function of the index, returning the computation
+        Targets of the family specified explicitly (e.g. a base case saved.data[0] = ...) take precedence over the rule.
+        '''
+        if family._idx is not None:
+            raise Exception("A rule must be given for a family of targets, not for %s" % family)
+        if family._name in self.rules:
+            raise Exception("Family %s has multiple rules" % family)
+        self.rules[family._name] = TargetRule(family._name, indices, rule)
+
+    def find_rule_invocation(self, target_str):
+        '''
+        Returns the pair (data object, computation) for a target specified by a rule, or None.
+        '''
+        if len(self.rules) == 0 or not target_str.endswith(']'):
+            return None
+        p = target_str.find('[')
+        rule = self.rules.get(target_str[:p], None) if p > 0 else None
+        return None if rule is None else rule.invocation(target_str[p+1:-1])
+
+    def iter_invocations(self):
+        '''
+        Iterates over the pairs (data object, computation) for all targets, including those specified by rules.
+        '''
+        for inv in self.all_invocations:
+            yield inv
+        for name in sorted(self.rules):
+            rule = self.rules[name]
+            for idx in rule.indices:
+                target = DataObjectDescriptor(name, idx)
+                if str(target) not in self.dependency_graph:
+                    yield (target, as_computation(rule.rule(idx)))
+
+    def iter_targets(self):
+        '''
+        Iterates over the names of all targets, including those specified by rules.
+        '''
+        for t in self.dependency_graph:
+            yield t
+        for name in sorted(self.rules):
+            for idx in self.rules[name].indices:
+                t = str(DataObjectDescriptor(name, idx))
+                if t not in self.dependency_graph:
+                    yield t
+
+    def get_dependencies(self, target_str):
+        '''
+        Returns the list of dependencies of a target, or None if the target is not specified.
+        '''
+        deps = self.dependency_graph.get(target_str, None)
+        if deps is None:
+            inv = self.find_rule_invocation(target_str)
+            if inv is not None:
+                deps = map(str, inv[1].dependencies())
+        return deps
 
     def set_main_target(self, data_object):
         self.main_target = data_object
 
     def find_invocation_for_target(self, target_str):
         i = self.invocation_idx.get(target_str, None)
-        return None if i is None else self.all_invocations[i]
+        return self.find_rule_invocation(target_str) if i is None else self.all_invocations[i]
 
-    #TODO: This stuff is prone to race conditions
     def find_next_step_to(self, target_str):
-        # Is it locked?
-        if self.is_locked(target_str):
-            return None
+        '''
+        Returns a target which can be computed right now on the way to target_str, or None if there is none.
+        '''
+        ready = self.find_ready_targets(target_str, first_only=True)
+        return ready[0] if len(ready) > 0 else None
 
-        # Is there a dependency record (if there were now target=... line, there would not be one)
-        deps = self.dependency_graph.get(target_str, None)
-        if deps is None:
-            return None
+    def find_ready_targets(self, target_str, status=None, first_only=False):
+        '''
+        Returns the list of targets that are needed for target_str and can be computed right now, i.e.
+        they are specified, not locked, not done and all of their dependencies are done.
+        target_str itself is not checked for being done.
+        The targets are listed in depth-first order, so that the first one is the one find_next_step_to returns.
+        The graph is traversed iteratively, each target is visited and its status looked up at most once.
+        status - object providing target_status(target_str), the scheme itself by default.
+        first_only - stop the traversal as soon as the first ready target is found.
+        '''
+        if status is None:
+            status = self
+        statuses = {target_str: status.target_status(target_str)}
+        visited = set()
+        ready = []
+        stack = [target_str]
+        while len(stack) > 0:
+            c = stack.pop()
+            if c in visited:
+                continue
+            visited.add(c)
+            deps = self.get_dependencies(c)
+            if deps is None or statuses[c] == TARGET_STATUS_LOCKED:
+                continue
+            todo = []
+            for k in deps:
+                if k not in statuses:
+                    statuses[k] = status.target_status(k)
+                if statuses[k] != TARGET_STATUS_DONE:
+                    todo.append(k)
+            if len(todo) == 0:
+                ready.append(c)
+                if first_only:
+                    break
+            else:
+                todo.reverse()
+                stack.extend(todo)
+        return ready
 
-        # Are there undone and unlocked dependencies?
-        all_done = True
-        for k in deps:
-            if self.is_locked(k):
-                all_done = False
-            elif not self.is_done(k):
-                nxt = self.find_next_step_to(k)
-                if nxt is not None:
-                    return nxt
-                else:
-                    all_done = False
+    def find_outdated_targets(self, target_str=None):
+        '''
+        Returns the list of targets (needed for target_str, a target or a list of them, or all targets) which are done, but whose outputs
+        are older than the output of one of their dependencies, or which depend on such outdated targets.
+        The targets are listed in the order they have to be recomputed. Each output is looked up once.
+        Missing outputs of dependencies do not make a target outdated (they may have been removed on purpose).
+        '''
+        if target_str is None:
+            targets = self.iter_targets()
+        elif isinstance(target_str, list):
+            targets = target_str
+        else:
+            targets = [target_str]
+        mtimes = dict()
+        outdated = dict()
+        order = []
+        for t in targets:
+            stack = [t]
+            while len(stack) > 0:
+                c = stack[-1]
+                if c in outdated:
+                    stack.pop()
+                    continue
+                deps = self.get_dependencies(c) or []
+                pending = [d for d in deps if d not in outdated]
+                if len(pending) > 0:
+                    stack.extend(pending)
+                    continue
+                stack.pop()
+                try:
+                    mtime = os.stat(self.target_filename(c)).st_mtime
+                except OSError:
+                    mtime = None
+                mtimes[c] = mtime
+                outdated[c] = mtime is not None and len([d for d in deps if outdated[d] or \
+                                                         (mtimes[d] is not None and mtimes[d] > mtime)]) > 0
+                if outdated[c]:
+                    order.append(c)
+        return order
 
-        if all_done:
-            return target_str
+    def group_targets(self, by='function', size=10):
+        '''
+        Splits the targets into batches of at most size targets, which can each be computed in one
+        process invocation (see the computebatch action). Returns a list of lists of targets,
+        the targets of each batch are listed in the order they have to be computed.
+        by='function' - a batch contains targets of the same function which do not depend on each other
+                        (they are at the same distance from the targets without dependencies).
+        by='chain' - a batch is a part of a chain of targets, each of which is the only dependency of the next one,
+                     which in turn is the only target depending on it.
+        '''
+        invocations = [(str(obj), comp) for (obj, comp) in self.iter_invocations()]
+        deps = dict()
+        for (t, comp) in invocations:
+            deps[t] = set(self.get_dependencies(t))
+        for t in deps:
+            deps[t].intersection_update(deps)
+        groups = []
+        if by == 'function':
+            depth = dict()
+            for (t, comp) in invocations:
+                stack = [t]
+                while len(stack) > 0:
+                    c = stack[-1]
+                    pending = [d for d in deps[c] if d not in depth]
+                    if len(pending) > 0:
+                        stack.extend(pending)
+                        continue
+                    stack.pop()
+                    depth[c] = 1 + max([0] + [depth[d] for d in deps[c]])
+            by_key = dict()
+            for (t, comp) in invocations:
+                key = (comp.name, depth[t])
+                if key not in by_key:
+                    by_key[key] = []
+                    groups.append(by_key[key])
+                by_key[key].append(t)
+        elif by == 'chain':
+            dependents = dict()
+            for (t, comp) in invocations:
+                for d in deps[t]:
+                    dependents.setdefault(d, []).append(t)
+            follows = lambda c: len(dependents.get(c, [])) == 1 and len(deps[dependents[c][0]]) == 1
+            inner = set([dependents[c][0] for c in deps if follows(c)])
+            for (t, comp) in invocations:
+                if t in inner:
+                    continue
+                chain = [t]
+                while follows(chain[-1]):
+                    chain.append(dependents[chain[-1]][0])
+                groups.append(chain)
         else:
-            return None
+            raise Exception("Unknown grouping: %s" % by)
+        return [g[i:i+size] for g in groups for i in xrange(0, len(g), size)]
+
+    def iter_build_steps(self, batches=None):
+        '''
+        Iterates over the lists of invocations to be computed together: the batches (see group_targets) and,
+        for each target not in any of them, a list with its own invocation.
+        '''
+        batch_of = dict()
+        for b in batches or []:
+            for t in b:
+                batch_of[t] = b
+        for (lhs, rhs) in self.iter_invocations():
+            b = batch_of.get(str(lhs), None)
+            if b is None:
+                yield [(lhs, rhs)]
+            elif b[0] == str(lhs):
+                yield [self.find_invocation_for_target(t) for t in b]
 
-    def save_makefile(self, compute_command, ostream=sys.stdout):
+    @staticmethod
+    def external_dependencies(step):
+        '''
+        Returns the dependencies of the invocations of a build step (see iter_build_steps), which are not computed by the step itself.
+        '''
+        outputs = set([str(lhs) for (lhs, rhs) in step])
+        result = []
+        for (lhs, rhs) in step:
+            result.extend([d for d in rhs.dependencies() if str(d) not in outputs])
+        return result
+
+    def save_makefile(self, compute_command, ostream=sys.stdout, priorities=None, batches=None, batch_command=None, secondary=False):
         '''
         compute_command - command that takes '[targetname]' as an argument and invokes the computation. Typically
         this would be something like "python this_script.py compute"
+        priorities - optional dict mapping targets to numbers (see telemetry.remaining_path_lengths). If given,
+        the first rule is "all", depending on the main target or, without one, on all targets nothing depends on,
+        and the prerequisites of it and of every rule are listed by decreasing priority: make considers
+        the prerequisites in this order, so it starts the targets with the highest priorities first.
+        batches - optional list of batches of targets (see group_targets), each computed by one rule using
+        batch_command (e.g. "python this_script.py computebatch") with the targets as arguments.
+        Such rules have grouped targets, which require GNU make 4.3. A batch mixing targets whose file names
+        contain % with others is computed by two rules, as make takes such names for patterns.
+        secondary - if True, all targets are declared secondary: make neither deletes them as intermediate files
+        nor recomputes those whose outputs were collected (see collector.py) while the targets depending on them
+        are up to date. This is always done with batches, as make may delete the outputs of grouped targets otherwise.
+        '''
+        filename = self.filename_cache()
+        quote = lambda obj: "\"%s\"" % str(obj).replace('"', '\\"').replace('$', '\\$')
+        steps = self.iter_build_steps(batches)
+        if priorities is not None:
+            by_priority = lambda obj: -priorities.get(str(obj), 0.0)
+            if self.main_target is not None:
+                goals = [str(self.main_target)]
+            else:
+                steps = list(steps)
+                needed = set()
+                for step in steps:
+                    for (lhs, rhs) in step:
+                        needed.update(map(str, rhs.dependencies()))
+                goals = sorted([str(lhs) for step in steps for (lhs, rhs) in step if str(lhs) not in needed], key=by_priority)
+            # The first rule is the default goal
+            print >>ostream, ".PHONY: all"
+            print >>ostream, "all: %s" % " ".join(map(filename, goals))
+        elif self.main_target is not None:
+            print >>ostream, "%s:" % filename(self.main_target)
+        if secondary or batches is not None:
+            print >>ostream, ".SECONDARY:"
+        for step in steps:
+            # make takes the names containing % (quoted characters, e.g. brackets) for patterns, which match
+            # only themselves here. Pattern and ordinary targets can not be mixed in one rule, so a batch
+            # with both is split. (A rule with several pattern targets is grouped without &:.)
+            patterns = [(lhs, rhs) for (lhs, rhs) in step if '%' in filename(lhs)]
+            ordinary = [(lhs, rhs) for (lhs, rhs) in step if '%' not in filename(lhs)]
+            for (part, separator) in [(patterns, ":"), (ordinary, " &:")]:
+                if len(part) == 0:
+                    continue
+                deps = self.external_dependencies(part)
+                if priorities is not None:
+                    deps.sort(key=by_priority)
+                if len(part) == 1:
+                    print >>ostream, "%s: %s" % (filename(part[0][0]), " ".join(map(filename, deps)))
+                    print >>ostream, "\t%s %s" % (compute_command, quote(part[0][0]))
+                else:
+                    print >>ostream, "%s%s %s" % (" ".join([filename(lhs) for (lhs, rhs) in part]), separator, " ".join(map(filename, deps)))
+                    print >>ostream, "\t%s %s" % (batch_command, " ".join([quote(lhs) for (lhs, rhs) in part]))
+
+    def save_ninja(self, compute_command, ostream=sys.stdout, pools=None, restat=False, batches=None, batch_command=None):
         '''
+        Writes a build file for ninja (http://ninja-build.org), which handles large schemes much faster than make.
+        compute_command - as for save_makefile.
+        pools - optional dict mapping function names to the maximal number of their computations
+                that ninja may run at the same time.
+        restat - if True, ninja checks after each computation whether the output has actually changed,
+                 and does not recompute the targets depending on it otherwise.
+        batches, batch_command - as for save_makefile.
+        Unlike make, ninja has no intermediate files: it recomputes each target whose output is missing,
+        so the outputs collected by "gc" or "run --collect" (see collector.py), compressed or not,
+        are recomputed together with everything depending on them.
+        '''
+        filename = self.filename_cache(ninja_escape)
+        quote = lambda obj: ninja_escape("'%s'" % str(obj).replace("'", "'\\''"), False)
+        pool_names = dict()
+        print >>ostream, "ninja_required_version = 1.3"
+        for (i, name) in enumerate(sorted(pools or [])):
+            pool_names[name] = "pool%d" % i
+            print >>ostream, "# %s\npool pool%d\n  depth = %d" % (name, i, pools[name])
+        for (rule, command) in [("compute", compute_command), ("computebatch", batch_command)]:
+            if command is None:
+                continue
+            print >>ostream, "rule %s\n  command = %s $target\n  description = Computing $target" % (rule, ninja_escape(command, False))
+            if restat:
+                print >>ostream, "  restat = 1"
+        for step in self.iter_build_steps(batches):
+            print >>ostream, "build %s: %s %s" % (" ".join([filename(lhs) for (lhs, rhs) in step]),
+                                                  "compute" if len(step) == 1 else "computebatch",
+                                                  " ".join(map(filename, self.external_dependencies(step))))
+            print >>ostream, "  target = %s" % " ".join([quote(lhs) for (lhs, rhs) in step])
+            if step[0][1].name in pool_names:
+                print >>ostream, "  pool = %s" % pool_names[step[0][1].name]
         if self.main_target is not None:
-            print >>ostream, "%s:" % self.target_filename(self.main_target)
-        for (lhs, rhs) in self.all_invocations:
-            print "%s: %s" % (self.target_filename(lhs), " ".join(map(self.target_filename, rhs.dependencies())))
-            print "\t%s \"%s\"" % (compute_command, str(lhs).replace('"', '\\"').replace('$', '\\$'))
+            print >>ostream, "default %s" % filename(self.main_target)
+
+    def filename_cache(self, transform=None):
+        '''
+        Returns a function which works as target_filename (optionally followed by transform),
+        but computes the name of each target only once.
+        '''
+        names = dict()
+        def filename(obj):
+            target_str = str(obj)
+            name = names.get(target_str, None)
+            if name is None:
+                name = self.target_filename(target_str)
+                if transform is not None:
+                    name = transform(name)
+                names[target_str] = name
+            return name
+        return filename
 
     def target_filename(self, obj):
-        return os.path.join(self.cache_dir, quote(str(obj)))
+        return os.path.join(self.cache_dir, self.target_cache_name(obj))
+
+    def target_cache_name(self, obj):
+        '''
+        Returns the name of the file for the given target, relative to cache_dir.
+        '''
+        return self.layout.cache_name(str(obj))
+
+    def status_snapshot(self):
+        '''
+        Returns an object which answers status queries for all targets at once, using a single
+        listing of cache_dir (see StatusSnapshot).
+        '''
+        return self.state_store.status_snapshot(self)
+
+    def target_status(self, target_str):
+        '''
+        Returns TARGET_STATUS_LOCKED, TARGET_STATUS_DONE or TARGET_STATUS_NONE for the given target.
+        '''
+        return self.state_store.target_status(self, target_str)
 
     def is_locked(self, target_str):
-        return os.path.exists(self.target_filename(target_str) + ".locked")
+        return self.target_status(target_str) == TARGET_STATUS_LOCKED
 
     def is_done(self, target_str):
-        return not self.is_locked(target_str) and os.path.exists(self.target_filename(target_str))
+        return self.target_status(target_str) == TARGET_STATUS_DONE
 
     def lock_target(self, target_str):
-        if self.is_locked(target_str):
+        '''
+        Atomically claims the target. Returns False if it is already locked.
+        '''
+        self.layout.prepare(self.cache_dir, target_str)
+        if not self.state_store.lock_target(self, target_str):
             return False
-        else:
-            f = open(self.target_filename(target_str) + ".locked", "w")
-            f.write(str(os.getpid()))
-            f.close()
-            return True
+        if hasattr(self.layout, 'record'):
+            self.layout.record(self.cache_dir, target_str)
+        return True
 
     def remove_target(self, target_str):
-        if os.path.exists(self.target_filename(target_str)):
-            os.unlink(self.target_filename(target_str))
+        for filename in [self.target_filename(target_str), self.target_filename(target_str) + COMPRESSED_SUFFIX]:
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+    def unlock_target(self, target_str, success=None):
+        '''
+        Releases the lock on the target. success (True/False), if known, is recorded by the state store.
+        '''
+        self.state_store.unlock_target(self, target_str, success)
 
-    def unlock_target(self, target_str):
-        if os.path.exists(self.target_filename(target_str) + ".locked"):
-            os.unlink(self.target_filename(target_str) + ".locked")
 
+def ninja_escape(s, path=True):
+    '''
+    Escapes a string for a ninja build file: $ is special everywhere, spaces and colons in paths.
+    '''
+    s = s.replace('$', '$$')
+    if path:
+        s = s.replace(' ', '$ ').replace(':', '$:')
+    return s
+
+def as_computation(value):
+    '''
+    Assigning a plain value (or a data object) to a target means copying it.
+    '''
+    return value if isinstance(value, ComputationDescriptor) else ComputationDescriptor(name='copy', args=[value])
+
+class IndexRange(object):
+    '''
+    Integer range with constant-time membership tests, used for the indices of rules.
+    '''
+    __slots__ = ('start', 'stop', 'step')
+    def __init__(self, start, stop, step=1):
+        self.start = start
+        self.stop = stop
+        self.step = step
+    @staticmethod
+    def from_xrange(r):
+        if len(r) == 0:
+            return IndexRange(0, 0)
+        step = r[1] - r[0] if len(r) > 1 else 1
+        return IndexRange(r[0], r[-1] + step, step)
+    def __contains__(self, i):
+        if self.step > 0 and not (self.start <= i < self.stop):
+            return False
+        if self.step < 0 and not (self.start >= i > self.stop):
+            return False
+        return (i - self.start) % self.step == 0
+    def __iter__(self):
+        return iter(xrange(self.start, self.stop, self.step))
+    def __len__(self):
+        return len(xrange(self.start, self.stop, self.step))
+
+class TargetRule(object):
+    '''
+    A family of targets name[i] for i in indices, each computed as rule(i). See ComputationScheme.add_rule.
+    The invocations of the most recently looked up targets are cached, least recently used ones are dropped.
+    '''
+    __slots__ = ('name', 'indices', 'rule', 'by_str', 'cache')
+    CACHE_SIZE = 10000
+
+    def __init__(self, name, indices, rule):
+        self.name = name
+        self.indices = IndexRange.from_xrange(indices) if isinstance(indices, xrange) else indices
+        self.rule = rule
+        self.by_str = None
+        self.cache = OrderedDict()  # idx_str -> invocation
+
+    def find_index(self, idx_str):
+        '''
+        Returns the index whose string form is idx_str, or None if there is no such index.
+        '''
+        if isinstance(self.indices, IndexRange):
+            try:
+                i = int(idx_str)
+            except ValueError:
+                return None
+            return i if i in self.indices and str(i) == idx_str else None
+        if self.by_str is None:
+            self.by_str = dict([(str(i), i) for i in self.indices])
+        return self.by_str.get(idx_str, None)
+
+    def invocation(self, idx_str):
+        inv = self.cache.pop(idx_str, None)
+        if inv is None:
+            i = self.find_index(idx_str)
+            if i is None:
+                return None
+            inv = (DataObjectDescriptor(self.name, i), as_computation(self.rule(i)))
+            if len(self.cache) >= self.CACHE_SIZE:
+                self.cache.popitem(last=False)
+        self.cache[idx_str] = inv
+        return inv
+
+class DependencyGraph(object):
+    '''
+    Mapping from target names to the lists of names of their dependencies, used as ComputationScheme.dependency_graph.
+    It is filled using add() and otherwise behaves as a read-only dict.
+    Internally, all names are interned and numbered, and the edges are kept in flat integer arrays (CSR format):
+    the dependencies of the target in row r are the node ids edges[offsets[r]:offsets[r+1]].
+    Rows are numbered in the order of addition, thus the row of a target is also its index in all_invocations.
+    '''
+    __slots__ = ('ids', 'names', 'rows', 'offsets', 'edges')
+
+    def __init__(self):
+        self.ids = dict()           # name -> node id
+        self.names = []             # node id -> name
+        self.rows = array('i')      # node id -> row, -1 for names without a specification
+        self.offsets = array('i', [0])
+        self.edges = array('i')
+
+    def node_id(self, name, create=True):
+        i = self.ids.get(name, None)
+        if i is None and create:
+            if type(name) is str:
+                name = intern(name)
+            i = len(self.names)
+            self.ids[name] = i
+            self.names.append(name)
+            self.rows.append(-1)
+        return i
+
+    def add(self, target, deps):
+        '''
+        Adds a target with the given list of dependencies. Returns the row of the target.
+        '''
+        n = self.node_id(target)
+        if self.rows[n] >= 0:
+            raise Exception("Target %s has multiple specifications" % target)
+        self.edges.extend([self.node_id(d) for d in deps])
+        self.rows[n] = len(self.offsets) - 1
+        self.offsets.append(len(self.edges))
+        return self.rows[n]
 
-class ComputationDescriptor:
+    def row(self, target):
+        '''
+        Returns the row of a target, or -1 if it is not specified.
+        '''
+        n = self.ids.get(target, None)
+        return -1 if n is None else self.rows[n]
+
+    def dependency_ids(self, node_id):
+        '''
+        Returns the array of node ids of the dependencies of the given node, or None if it is not specified.
+        '''
+        r = self.rows[node_id]
+        return None if r < 0 else self.edges[self.offsets[r]:self.offsets[r+1]]
+
+    def get(self, target, default=None):
+        r = self.row(target)
+        if r < 0:
+            return default
+        names = self.names
+        return [names[k] for k in self.edges[self.offsets[r]:self.offsets[r+1]]]
+
+    def __getitem__(self, target):
+        deps = self.get(target, None)
+        if deps is None:
+            raise KeyError(target)
+        return deps
+
+    def __contains__(self, target):
+        return self.row(target) >= 0
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        # Targets, in the order they were added
+        names = self.names
+        rows = self.rows
+        order = array('i', [0]) * len(self)
+        for n in xrange(len(names)):
+            if rows[n] >= 0:
+                order[rows[n]] = n
+        return (names[n] for n in order)
+
+    def keys(self):
+        return list(iter(self))
+
+    def __getstate__(self):
+        return (self.names, self.rows.tostring(), self.offsets.tostring(), self.edges.tostring())
+
+    def __setstate__(self, state):
+        (names, rows, offsets, edges) = state
+        self.names = [intern(n) if type(n) is str else n for n in names]
+        self.ids = dict(izip(self.names, count()))
+        self.rows = array('i')
+        self.rows.fromstring(rows)
+        self.offsets = array('i')
+        self.offsets.fromstring(offsets)
+        self.edges = array('i')
+        self.edges.fromstring(edges)
+
+    def iteritems(self):
+        return ((t, self.get(t)) for t in self)
+
+    def items(self):
+        return list(self.iteritems())
+
+class InvocationIndex(object):
+    '''
+    Read-only mapping from target names to their indices in all_invocations, as ComputationScheme.invocation_idx.
+    It is a view of the rows of a DependencyGraph and takes no memory of its own.
+    '''
+    __slots__ = ('graph',)
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def get(self, target, default=None):
+        r = self.graph.row(target)
+        return default if r < 0 else r
+
+    def __getitem__(self, target):
+        r = self.graph.row(target)
+        if r < 0:
+            raise KeyError(target)
+        return r
+
+    def __contains__(self, target):
+        return self.graph.row(target) >= 0
+
+    def __len__(self):
+        return len(self.graph)
+
+    def __iter__(self):
+        return iter(self.graph)
+
+
+CANONICAL_SCALAR_TYPES = (type(None), bool, int, long, float, str, unicode)
+
+def canonical_value(value):
+    '''
+    Returns a hashable representation of an argument of a computation, including its type.
+    Raises TypeError for values which can not be represented faithfully (see ComputationDescriptor.canonical_key).
+    '''
+    if isinstance(value, DataObjectDescriptor):
+        return ('target', str(value))
+    elif type(value) in CANONICAL_SCALAR_TYPES:
+        return (type(value).__name__, value)
+    elif type(value) in (list, tuple):
+        return (type(value).__name__, tuple([canonical_value(v) for v in value]))
+    elif type(value) is dict:
+        return ('dict', tuple(sorted([(canonical_value(k), canonical_value(v)) for (k, v) in value.iteritems()])))
+    raise TypeError("No canonical representation for %s" % type(value).__name__)
+
+class ComputationDescriptor(object):
+    __slots__ = ('name', 'args', 'kwargs', '__str')     # (__str is private, so that run.mod._str is a computation)
     def __init__(self, name=None, args=None, kwargs=None):
         self.name = name
         self.args = args
         self.kwargs = kwargs
+        self.__str = None  # Computed on first use
     def __getattr__(self, name):
         newname = name if self.name is None else self.name + '.' + name
         return ComputationDescriptor(newname)
     def __call__(self, *args, **kw):
-        return ComputationDescriptor(self.name, args, kw)
+        return ComputationDescriptor(self.name, args, kw if len(kw) > 0 else None)
+    def __reduce__(self):
+        return (ComputationDescriptor, (self.name, self.args, self.kwargs))
     def __repr__(self):
         return self.__str__()
     def __str__(self):
+        if self.__str is None:
+            self.__str = self.make_str()
+        return self.__str
+    def make_str(self):
         if self.name is None:
             return "--"
         s = self.name + "("
@@ -151,32 +773,51 @@ class ComputationDescriptor:
             s = s + ",".join(map(lambda (x,y): "%s=%s" % (str(x),str(y)), self.kwargs.iteritems()))
         s = s + ")"
         return s
+    def canonical_key(self):
+        """Returns a hashable key, equal for equal computations: the name together with the arguments, each
+        represented with its type (so that f(1) and f('1') differ), keyword arguments sorted.
+        Returns None if some argument is not a data object, a number, a string, None or a list, tuple or dict of these,
+        as other values (e.g. arrays, whose str() is abbreviated) can not be compared faithfully."""
+        try:
+            args = tuple([canonical_value(a) for a in self.args or []])
+            kwargs = tuple([(k, canonical_value(self.kwargs[k])) for k in sorted(self.kwargs or [])])
+        except TypeError:
+            return None
+        return (self.name, args, kwargs)
+    def special_kwarg(self, name, default=None):
+        """Returns the value of a special keyword argument (such as _serializer), or default if it is not given"""
+        return self.kwargs.get(name, default) if self.kwargs is not None else default
     def dependencies(self):
         """Returns a list of parameters which are of type DataObjectDescritor"""
         result = ComputationDescriptor.extract_data_objects(self.args)
         if self.kwargs is not None:
-            result = result + ComputationDescriptor.extract_data_objects(self.kwargs.values())
+            ComputationDescriptor.extract_data_objects(self.kwargs.values(), result)
         return result
 
     @staticmethod
-    def extract_data_objects(lst):
-        """Given a list of elements extracts those of type DataObjectDescriptor. Descends recursively into sublists. When given None, returns []."""
-        res = []
+    def extract_data_objects(lst, res=None):
+        """Given a list of elements extracts those of type DataObjectDescriptor. Descends recursively into sublists. When given None, returns [].
+        If res is given, the elements are appended to it."""
+        if res is None:
+            res = []
         if lst is None:
             return res
         for el in lst:
             if isinstance(el, DataObjectDescriptor):
                 res.append(el)
             elif isinstance(el, list) or isinstance(el, tuple):
-                res = res + ComputationDescriptor.extract_data_objects(el)
+                ComputationDescriptor.extract_data_objects(el, res)
         return res
 
 
-class DataObjectDescriptor:
+class DataObjectDescriptor(object):
+    __slots__ = ('_name', '_idx', '_scheme', '__str')   # (__str is private, so that saved._str is a target)
     def __init__(self, name=None, idx=None, scheme=None):
-        self.__dict__['_name'] = name  # Avoid self._name as it will invoke setattr here
-        self.__dict__['_idx'] = idx
-        self.__dict__['_scheme'] = scheme
+        object.__setattr__(self, '_name', name)  # Avoid self._name as it will invoke setattr here
+        object.__setattr__(self, '_idx', idx)
+        object.__setattr__(self, '_scheme', scheme)
+        s = "--" if name is None else name if idx is None else name + "[%s]" % str(idx)
+        object.__setattr__(self, '_DataObjectDescriptor__str', intern(s) if type(s) is str else s)  # Shared with the dependency graph
     def __getattr__(self, name):
         return DataObjectDescriptor(name, scheme = self._scheme)
     def __setattr__(self, name, value):
@@ -184,15 +825,13 @@ class DataObjectDescriptor:
         self._scheme.add_invocation(newobject, value)
     def __getitem__(self, idx):
         return DataObjectDescriptor(self._name, idx, self._scheme)
+    def __reduce__(self):
+        # The scheme is only needed while the experiment is being defined and is not pickled
+        return (DataObjectDescriptor, (self._name, self._idx))
     def __setitem__(self, idx, value):
         newobject = DataObjectDescriptor(self._name, idx)
         self._scheme.add_invocation(newobject, value)
     def __repr__(self):
         return self.__str__()
     def __str__(self):
-        if self._name is None:
-            return "--"
-        s = self._name
-        if self._idx is not None:
-            s = s + "[%s]" % str(self._idx)
-        return s
+        return self.__str
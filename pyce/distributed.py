@@ -0,0 +1,447 @@
+'''
+PyCE: Computational experiment management framework.
+
+Coordinator and workers for computing on several nodes
+Copyright 2010, Konstantin Tretyakov.
+Licensed under the BSD (3-clause) license.
+'''
+
+'''
+The "coordinator" action builds the scheme, finds the targets needed for the given target and
+hands them out over TCP to the workers started with the "worker" action (on any number of nodes):
+    $ python experiment.py coordinator --listen 0.0.0.0:7450 saved.result
+    $ python experiment.py worker --connect coordinator-host:7450      (on each node, possibly several times)
+The coordinator alone decides which worker computes which target, so no lock files are needed.
+The outputs are still written to the cache directory, which must thus be shared by the nodes.
+
+Workers pull targets: each request is answered with a target whose dependencies are done, together
+with a lease (in seconds). While computing, a worker renews the lease with heartbeats. A target whose
+lease expires, or whose worker disconnects, is handed out again; the worker losing a lease stops
+computing it. When the target is built (or can not be built), the workers are told to exit.
+
+Each computation writes its output under a private temporary name, which is then linked to the
+output file of the target. Only the first computation to finish succeeds in doing so, so a computation
+stopped halfway or finished late never leaves a partial output behind.
+
+With speculation (the --speculate <factor> option), a target running factor times longer than
+the computations of its function usually take (see telemetry.DurationEstimates) is handed out
+once more, to another worker, when no other target is ready. The first of the two computations
+to finish is kept, the other one loses its lease and is stopped. This keeps a slow node
+from holding up the rest of the computation.
+
+Messages are JSON objects, one per line, each request of a worker is answered with exactly one reply:
+    {"op": "request", "worker": w}              -> {"target": t, "lease": s}, {"wait": s} or {"exit": true}
+    {"op": "heartbeat", "worker": w, "target": t}   -> {"ok": true} or {"ok": false} if the lease is lost
+    {"op": "finished", "worker": w, "target": t, "result": r, "wall": s}   -> {"ok": true}
+where r is the result of compute_target (see util.py) and s are seconds.
+'''
+
+import os, sys, time, json, errno, socket, select, signal, traceback
+from executor import collect_pending_targets, ReadyQueue
+from state import FileStateStore, TARGET_STATUS_DONE, TARGET_STATUS_NONE, COMPRESSED_SUFFIX
+from telemetry import critical_path_priorities, DurationEstimates
+from util import compute_target, COMPUTE_TARGET_RESULT_MSG, STEP_RUN_OK, STEP_RUN_FAILED, STEP_RUN_FAILED_WITH_EXCEPTION, \
+                 TARGET_NOT_FOUND, TARGET_READY, NO_STEPS_AVAILABLE
+
+DEFAULT_PORT = 7450
+
+def parse_address(address):
+    '''
+    Converts "host:port" (or just "host") to a (host, port) tuple.
+    '''
+    (host, sep, port) = address.rpartition(':')
+    if not sep:
+        return (address, DEFAULT_PORT)
+    if not port.isdigit():
+        raise Exception("Invalid address: %s" % address)
+    return (host, int(port))
+
+class Coordinator:
+    '''
+    Keeps the frontier of the targets needed for final_target_str and the leases of the workers.
+    The methods are not thread-safe, they are called from the single loop of coordinate().
+    '''
+    def __init__(self, scheme, final_target_str, lease_time=30.0, critical_path=False, speculate=None):
+        self.scheme = scheme
+        self.final_target_str = final_target_str
+        self.lease_time = lease_time
+        self.speculate = speculate
+        snapshot = scheme.status_snapshot()
+        (self.waiting_for, self.dependents, blocked) = collect_pending_targets(scheme, final_target_str, snapshot)
+        for b in blocked:
+            print "Target can not be built here (locked or unspecified): %s" % b
+        self.estimates = DurationEstimates(scheme) if critical_path or speculate is not None else None
+        priorities = critical_path_priorities(scheme, final_target_str, snapshot, self.estimates) if critical_path else None
+        self.ready = ReadyQueue([t for t in self.waiting_for if self.waiting_for[t] == 0], priorities)
+        self.leases = dict()        # target -> {worker: [expiration time, start time]}
+        self.deferred = dict()      # target -> equivalent targets waiting for it
+        self.completed = set()
+        self.failed = False
+        self.durations = []
+
+    def is_finished(self):
+        return self.final_target_str in self.completed or (len(self.ready) == 0 and len(self.leases) == 0)
+
+    def next_target(self, worker):
+        '''
+        Leases the next ready target to the worker, returns None if there is none.
+        '''
+        now = time.time()
+        while len(self.ready) > 0:
+            t = self.ready.popleft()
+            if t in self.completed or t in self.leases:
+                continue
+            # Do not compute the same thing twice in parallel, wait for the leased equivalent target instead
+            leased_equivalent = [e for e in self.scheme.find_equivalent_targets(t) if e in self.leases]
+            if len(leased_equivalent) > 0:
+                self.deferred.setdefault(leased_equivalent[0], []).append(t)
+                continue
+            self.leases[t] = {worker: [now + self.lease_time, now]}
+            print "Leased to %s: %s" % (worker, t)
+            return t
+        t = self.find_straggler(worker, now)
+        if t is not None:
+            self.leases[t][worker] = [now + self.lease_time, now]
+            print "Leased to %s (speculatively): %s" % (worker, t)
+        return t
+
+    def find_straggler(self, worker, now):
+        '''
+        Returns the leased target which has been computed longest compared to the expected duration
+        of its function, if it exceeds the speculation factor and is not already computed twice.
+        '''
+        if self.speculate is None:
+            return None
+        best = (self.speculate, None)
+        for (t, leases) in self.leases.iteritems():
+            if len(leases) > 1 or worker in leases:
+                continue
+            inv = self.scheme.find_invocation_for_target(t)
+            expected = self.estimates.function_estimate(inv[1].name if inv is not None else None)
+            started = leases.values()[0][1]
+            best = max(best, ((now - started) / max(expected, 1e-3), t))
+        return best[1]
+
+    def heartbeat(self, worker, target_str):
+        '''
+        Renews the lease, returns False if the worker does not hold it any more.
+        '''
+        lease = self.leases.get(target_str, {}).get(worker)
+        if lease is None:
+            return False
+        lease[0] = time.time() + self.lease_time
+        return True
+
+    def revoke(self, target_str, worker, reason):
+        '''
+        Removes the lease of the worker. The target is handed out again, unless another worker computes it.
+        '''
+        print "%s: %s" % (reason, target_str)
+        leases = self.leases[target_str]
+        del leases[worker]
+        if len(leases) == 0:
+            del self.leases[target_str]
+            self.ready.extend([target_str] + self.deferred.pop(target_str, []))
+
+    def expire_leases(self):
+        now = time.time()
+        for (t, leases) in self.leases.items():
+            for (worker, (expires, started)) in leases.items():
+                if expires < now:
+                    self.revoke(t, worker, "Lease of %s expired" % worker)
+
+    def worker_lost(self, worker):
+        for (t, leases) in self.leases.items():
+            if worker in leases:
+                self.revoke(t, worker, "Worker %s disconnected" % worker)
+
+    def finished(self, worker, target_str, result, wall):
+        if target_str in self.completed or target_str not in self.waiting_for:
+            return
+        leases = self.leases.get(target_str, {})
+        if worker not in leases:
+            # A late report of a revoked lease is only of use if the computation succeeded
+            if result != STEP_RUN_OK:
+                return
+        elif result != STEP_RUN_OK and len(leases) > 1:
+            # The other computation of the target may still succeed
+            self.revoke(target_str, worker, "%s (%s)" % (COMPUTE_TARGET_RESULT_MSG[result], worker))
+            return
+        # The other computations of the target lose their leases and are stopped
+        self.leases.pop(target_str, None)
+        print "%s (%s, %.3f s): %s" % (COMPUTE_TARGET_RESULT_MSG[result], worker, wall, target_str)
+        sys.stdout.flush()
+        if result != STEP_RUN_OK:
+            self.failed = True
+            self.ready.extend(self.deferred.pop(target_str, []))
+            return
+        self.durations.append(wall)
+        if self.estimates is not None:
+            inv = self.scheme.find_invocation_for_target(target_str)
+            self.estimates.record(target_str, inv[1].name if inv is not None else None, wall)
+        # Equivalent targets have received the shared output
+        newly_done = [target_str] + [e for e in self.scheme.find_equivalent_targets(target_str) if e in self.waiting_for \
+                                     and e not in self.leases and e not in self.completed and self.scheme.is_done(e)]
+        self.ready.extend([e for e in self.deferred.pop(target_str, []) if e not in newly_done])
+        for c in newly_done:
+            self.completed.add(c)
+            for d in self.dependents[c]:
+                self.waiting_for[d] = self.waiting_for[d] - 1
+                if self.waiting_for[d] == 0:
+                    self.ready.append(d)
+
+    def handle(self, message):
+        '''
+        Returns the reply to a message of a worker.
+        '''
+        op = message.get('op')
+        worker = message.get('worker')
+        if op == 'request':
+            if self.is_finished():
+                return dict(exit=True)
+            t = self.next_target(worker)
+            if t is None:
+                return dict(wait=min(1.0, self.lease_time / 4))
+            return dict(target=t, lease=self.lease_time)
+        elif op == 'heartbeat':
+            return dict(ok=self.heartbeat(worker, message['target']))
+        elif op == 'finished':
+            self.finished(worker, message['target'], message['result'], message.get('wall', 0.0))
+            return dict(ok=True)
+        else:
+            raise Exception("Unknown message: %s" % op)
+
+    def result(self):
+        if self.final_target_str in self.completed:
+            return STEP_RUN_OK
+        elif self.failed:
+            return STEP_RUN_FAILED
+        else:
+            return NO_STEPS_AVAILABLE
+
+def coordinate(scheme, final_target_str, address, lease_time=30.0, critical_path=False, speculate=None):
+    '''
+    Hands out the targets needed for final_target_str to the workers connecting to address ("host:port")
+    until the final target is built or no more targets can be built. With speculate (a factor, see above),
+    the computations of stragglers are duplicated. Then waits (at most lease_time seconds)
+    for the connected workers to be told to exit.
+    Returns STEP_RUN_OK, TARGET_NOT_FOUND, TARGET_READY, STEP_RUN_FAILED or NO_STEPS_AVAILABLE,
+    with the same meaning as for run_to_target.
+    '''
+    if not scheme.target_exists(final_target_str):
+        return TARGET_NOT_FOUND
+    if scheme.is_done(final_target_str):
+        return TARGET_READY
+    coordinator = Coordinator(scheme, final_target_str, lease_time, critical_path, speculate)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(parse_address(address))
+    server.listen(128)
+    print "Coordinating on %s:%d" % server.getsockname()
+    sys.stdout.flush()
+    buffers = dict()        # connection -> data received after the last complete message
+    workers = dict()        # connection -> name of the worker
+    finished_at = None
+    try:
+        while finished_at is None or (len(buffers) > 0 and time.time() < finished_at + lease_time):
+            try:
+                (readable, _, _) = select.select([server] + buffers.keys(), [], [], 0.5)
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            for s in readable:
+                if s is server:
+                    (conn, addr) = server.accept()
+                    buffers[conn] = ""
+                    continue
+                try:
+                    data = s.recv(65536)
+                except socket.error:
+                    data = ""
+                if not data:
+                    if s in workers:
+                        coordinator.worker_lost(workers.pop(s))
+                    del buffers[s]
+                    s.close()
+                    continue
+                lines = (buffers[s] + data).split("\n")
+                buffers[s] = lines.pop()
+                for line in lines:
+                    message = json.loads(line)
+                    workers[s] = message.get('worker')
+                    s.sendall(json.dumps(coordinator.handle(message)) + "\n")
+            coordinator.expire_leases()
+            if finished_at is None and coordinator.is_finished():
+                finished_at = time.time()
+    finally:
+        for conn in buffers:
+            conn.close()
+        server.close()
+    if len(coordinator.durations) > 0:
+        print "Computed %d targets, %.3f s in total" % (len(coordinator.durations), sum(coordinator.durations))
+    return coordinator.result()
+
+class LeasedStateStore(FileStateStore):
+    '''
+    State store of the workers. The coordinator leases each target to a single worker,
+    so the lease stands for the lock and no lock files are created.
+    A compressed output (see collector.py) counts as done, it is restored when a computation reads it.
+    '''
+    def target_status(self, scheme, target_str):
+        filename = scheme.target_filename(target_str)
+        if os.path.exists(filename) or os.path.exists(filename + COMPRESSED_SUFFIX):
+            return TARGET_STATUS_DONE
+        return TARGET_STATUS_NONE
+
+    def lock_target(self, scheme, target_str):
+        return True
+
+    def unlock_target(self, scheme, target_str, success=None):
+        pass
+
+class PrivateOutputLayout:
+    '''
+    Layout used while a worker computes a target: the output of that target goes to a private temporary
+    file (see publish_output), all other files are where the wrapped layout puts them.
+    '''
+    def __init__(self, layout, target_str, suffix):
+        self.layout = layout
+        self.target_str = target_str
+        self.suffix = suffix
+
+    def cache_name(self, target_str):
+        name = self.layout.cache_name(target_str)
+        return name + self.suffix if target_str == self.target_str else name
+
+    def list_cache(self, cache_dir):
+        return self.layout.list_cache(cache_dir)
+
+    def prepare(self, cache_dir, target_str):
+        self.layout.prepare(cache_dir, target_str)
+
+    def record(self, cache_dir, target_str):
+        if hasattr(self.layout, 'record'):
+            self.layout.record(cache_dir, target_str)
+
+def private_suffix(pid):
+    return ".%s.%d.tmp" % (socket.gethostname(), pid)
+
+def publish_output(private_filename, filename):
+    '''
+    Makes the private output the output of the target by an atomic hard link, unless another
+    computation has done so first. Returns False in that case. The private file is removed.
+    '''
+    if not os.path.exists(private_filename):
+        return True
+    try:
+        os.link(private_filename, filename)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+        return False
+    finally:
+        os.unlink(private_filename)
+    return True
+
+class CoordinatorConnection:
+    '''
+    Connection of a worker to the coordinator.
+    '''
+    def __init__(self, address, worker, timeout=10.0):
+        '''
+        Connects to address ("host:port"), retrying for timeout seconds, so that workers may be started before the coordinator.
+        '''
+        self.worker = worker
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self.socket = socket.create_connection(parse_address(address))
+                break
+            except socket.error:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.5)
+        self.file = self.socket.makefile('r')
+
+    def call(self, op, **kw):
+        kw.update(op=op, worker=self.worker)
+        self.socket.sendall(json.dumps(kw) + "\n")
+        line = self.file.readline()
+        if not line:
+            raise Exception("The coordinator closed the connection")
+        return json.loads(line)
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+def work(scheme, computation_runner, address):
+    '''
+    Computes the targets handed out by the coordinator at address ("host:port") until told to exit.
+    Each target is computed with compute_target in a forked process, while the lease is renewed
+    every third of its duration. If the lease is lost, the computation is killed.
+    The output is written to a private file first and published when the computation succeeds.
+    Returns the number of targets computed successfully.
+    '''
+    scheme.state_store = LeasedStateStore()
+    # The results are needed by other workers, so results kept in memory must also be written out
+    if getattr(computation_runner, 'result_store', None) is not None:
+        computation_runner.result_store.write_through = True
+    connection = CoordinatorConnection(address, "%s:%d" % (socket.gethostname(), os.getpid()))
+    print "Connected to %s as %s" % (address, connection.worker)
+    computed = 0
+    try:
+        while True:
+            reply = connection.call('request')
+            if reply.get('exit'):
+                break
+            if 'wait' in reply:
+                time.sleep(reply['wait'])
+                continue
+            target_str = reply['target']
+            started = time.time()
+            sys.stdout.flush()
+            pid = os.fork()
+            if pid == 0:
+                connection.socket.close()
+                result = STEP_RUN_FAILED_WITH_EXCEPTION
+                try:
+                    filename = scheme.target_filename(target_str)
+                    scheme.layout = PrivateOutputLayout(scheme.layout, target_str, private_suffix(os.getpid()))
+                    result = compute_target(scheme, computation_runner, target_str)
+                    if result == STEP_RUN_OK and not publish_output(scheme.target_filename(target_str), filename):
+                        print "Output computed first by another worker: %s" % target_str
+                except:
+                    traceback.print_exc()
+                finally:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(result)
+            result = None
+            renewed = started
+            while result is None:
+                (p, status) = os.waitpid(pid, os.WNOHANG)
+                if p == pid:
+                    result = os.WEXITSTATUS(status) if os.WIFEXITED(status) else STEP_RUN_FAILED_WITH_EXCEPTION
+                elif time.time() > renewed + reply['lease'] / 3:
+                    if not connection.call('heartbeat', target=target_str)['ok']:
+                        print "Lease lost, computation stopped: %s" % target_str
+                        os.kill(pid, signal.SIGKILL)
+                        os.waitpid(pid, 0)
+                        private_filename = scheme.target_filename(target_str) + private_suffix(pid)
+                        if os.path.exists(private_filename):
+                            os.unlink(private_filename)
+                        break
+                    renewed = time.time()
+                else:
+                    time.sleep(0.05)
+            if result is None:
+                continue
+            connection.call('finished', target=target_str, result=result, wall=time.time() - started)
+            if result == STEP_RUN_OK:
+                computed = computed + 1
+    finally:
+        connection.close()
+    print "Computed %d targets" % computed
+    return computed
@@ -0,0 +1,428 @@
+'''
+PyCE: Computational experiment management framework.
+
+In-process parallel executor
+Copyright 2010, Konstantin Tretyakov.
+Licensed under the BSD (3-clause) license.
+'''
+
+import os, sys, traceback, multiprocessing, multiprocessing.pool, multiprocessing.queues, Queue, heapq
+from collections import deque
+from telemetry import critical_path_priorities
+from resources import target_resources
+from serializers import SERIALIZERS
+from collector import dependent_targets
+from state import TARGET_STATUS_LOCKED, TARGET_STATUS_DONE
+from util import compute_target, compute_targets, STEP_RUN_OK, STEP_RUN_FAILED, STEP_RUN_FAILED_WITH_EXCEPTION, \
+                 TARGET_NOT_FOUND, TARGET_READY, NO_STEPS_AVAILABLE
+
+# -------------- Worker side -----------------
+# The scheme and the runner are handed to the pool workers once, via the initializer.
+# As the pool is forked, they are never pickled.
+_worker_scheme = None
+_worker_runner = None
+_worker_started = None
+
+def _init_worker(scheme, computation_runner, started=None):
+    global _worker_scheme, _worker_runner, _worker_started
+    _worker_scheme = scheme
+    _worker_runner = computation_runner
+    _worker_started = started
+    # Dependent targets may be computed by other workers, so results kept in memory must also be written out
+    if getattr(computation_runner, 'result_store', None) is not None:
+        computation_runner.result_store.write_through = True
+
+def _run_worker_batch(target_strs):
+    # Tells the driver which worker computes the batch, see lost_batch_results
+    if _worker_started is not None:
+        _worker_started.put((os.getpid(), target_strs[0]))
+    # apply_async has no error callback: the driver must always receive the results
+    try:
+        return compute_targets(_worker_scheme, _worker_runner, target_strs)
+    except:
+        traceback.print_exc()
+        for t in target_strs:
+            print "Target failed with exception: %s" % t
+            _worker_scheme.remove_target(t)
+            _worker_scheme.unlock_target(t, False)
+        sys.stdout.flush()
+        return [STEP_RUN_FAILED_WITH_EXCEPTION for t in target_strs]
+
+# -------------- Driver side -----------------
+def collect_pending_targets(scheme, final_target_str, status=None):
+    '''
+    Walks the dependency graph from final_target_str once and returns a tuple
+    (waiting_for, dependents, blocked), where
+    * waiting_for maps each target that still has to be built to the number of its unfinished dependencies,
+    * dependents maps each such target to the list of pending targets that need it,
+    * blocked is the set of targets which can not be built by us: they are either locked or have no specification.
+    Targets which are done are not included anywhere.
+    status - object providing target_status(target_str), a fresh StatusSnapshot by default.
+    '''
+    if status is None:
+        status = scheme.status_snapshot()
+    waiting_for = dict()
+    dependents = dict()
+    blocked = set()
+    statuses = {final_target_str: status.target_status(final_target_str)}
+    stack = [final_target_str]
+    while len(stack) > 0:
+        c = stack.pop()
+        deps = scheme.get_dependencies(c)
+        if deps is None or statuses[c] == TARGET_STATUS_LOCKED:
+            blocked.add(c)
+            continue
+        waiting_for[c] = 0
+        dependents.setdefault(c, [])
+        for k in deps:
+            if k not in statuses:
+                statuses[k] = status.target_status(k)
+                if statuses[k] != TARGET_STATUS_DONE:
+                    stack.append(k)
+            if statuses[k] == TARGET_STATUS_DONE:
+                continue
+            waiting_for[c] = waiting_for[c] + 1
+            dependents.setdefault(k, []).append(c)
+    return (waiting_for, dependents, blocked)
+
+def is_stream_producer(scheme, computation_runner, target_str):
+    '''
+    Tells whether the target is a streaming target (saved with the 'stream' serializer, see serializers.py),
+    with the serializer chosen for it by the runner (see PythonFunctionRunner.serializer_name).
+    '''
+    inv = scheme.find_invocation_for_target(target_str)
+    if inv is None:
+        return False
+    if hasattr(computation_runner, 'serializer_name'):
+        name = computation_runner.serializer_name(target_str, inv[1])
+    else:
+        name = inv[1].special_kwarg('_serializer')
+    return getattr(SERIALIZERS.get(name), 'streams', False)
+
+def is_stream_consumer(scheme, target_str):
+    '''
+    Tells whether the target may be started as soon as its streaming dependencies are started.
+    '''
+    inv = scheme.find_invocation_for_target(target_str)
+    return inv is not None and bool(inv[1].special_kwarg('_stream_consumer', False))
+
+class ReadyQueue:
+    '''
+    Targets ready to be computed: in the order they became ready, or, if priorities
+    (a dict mapping targets to numbers) are given, highest priority first.
+    '''
+    def __init__(self, targets, priorities=None):
+        self.priorities = priorities
+        self.targets = deque()
+        self.heap = []
+        self.extend(targets)
+
+    def __len__(self):
+        return len(self.targets) + len(self.heap)
+
+    def append(self, t):
+        if self.priorities is None:
+            self.targets.append(t)
+        else:
+            heapq.heappush(self.heap, (-self.priorities.get(t, 0.0), t))
+
+    def extend(self, targets):
+        for t in targets:
+            self.append(t)
+
+    def popleft(self):
+        if self.priorities is None:
+            return self.targets.popleft()
+        return heapq.heappop(self.heap)[1]
+
+def function_name(scheme, target_str):
+    inv = scheme.find_invocation_for_target(target_str)
+    return inv[1].name if inv is not None else None
+
+def is_io_bound(scheme, computation_runner, target_str):
+    '''
+    Tells whether the runner considers the computation of the target I/O-bound (see AsyncFunctionRunner).
+    '''
+    if not hasattr(computation_runner, 'is_io_bound'):
+        return False
+    inv = scheme.find_invocation_for_target(target_str)
+    return inv is not None and computation_runner.is_io_bound(inv[1])
+
+def lost_batch_results(scheme, batch):
+    '''
+    Returns the results of a batch whose worker died (e.g. killed by the OOM killer): targets that are done
+    succeeded, the others failed. The outputs and locks left by the worker are removed.
+    '''
+    results = []
+    for t in batch:
+        if scheme.is_done(t):
+            results.append(STEP_RUN_OK)
+            continue
+        if scheme.is_locked(t):
+            scheme.remove_target(t)
+            scheme.unlock_target(t, False)
+        print "Target failed, its worker died: %s" % t
+        results.append(STEP_RUN_FAILED)
+    return results
+
+def needs_at_most(scheme, target_str, request):
+    needs = target_resources(scheme, target_str)
+    return len([k for k in needs if needs[k] > request.get(k, 0)]) == 0
+
+def run_to_target(scheme, computation_runner, final_target_str, jobs=1, critical_path=False, batch_by=None, batch_size=10, io_jobs=0,
+                  ledger=None, collector=None):
+    '''
+    Builds final_target_str together with all of its missing dependencies.
+    The dependency graph is traversed once, after which the targets are dispatched
+    to a pool of "jobs" worker processes as soon as their dependencies are complete.
+    Each target is computed using compute_target, i.e. it is locked for the duration of the computation.
+    When jobs is 1, targets are computed in the current process. If the runner keeps results in memory
+    (see ResultStore), they are then written out only at the end, and the results of intermediate targets
+    are released as soon as all targets needing them are computed. Such targets will not be considered done later,
+    unless some target outside of this computation depends on them: their results are written out before release.
+    When jobs > 1, stream consumers are dispatched together with the streaming targets they use
+    (see is_stream_producer and is_stream_consumer). Streaming targets are therefore not computed
+    in batches with other targets, except for those following them in a chain.
+    With critical_path, the ready targets on the longest remaining paths are dispatched first
+    (see telemetry.critical_path_priorities).
+    With batch_by, batches of up to batch_size targets are computed together (see util.compute_targets,
+    which also calls batchable functions once for the whole batch): ready targets of the same function (batch_by='function') or a ready target
+    followed by the targets of the chain it starts (batch_by='chain', see ComputationScheme.group_targets).
+    With io_jobs > 0, the targets the runner considers I/O-bound (see AsyncFunctionRunner) are computed
+    in up to io_jobs threads of the current process, in addition to the "jobs" other computations.
+    With a ledger (see resources.ResourceLedger), a computation is started only when the resources it declares
+    fit together with those of the running ones. Other targets of a batch must not need more than the first one.
+    With a collector (see collector.GarbageCollector), the outputs of intermediate targets are collected
+    once the targets needing them are done.
+    When jobs > 1, the targets of a batch whose worker process died (e.g. killed by the OOM killer)
+    are considered failed (see lost_batch_results).
+
+    Returns STEP_RUN_OK if the final target was built, TARGET_NOT_FOUND or TARGET_READY
+    with the same meaning as in do_step_to_target, STEP_RUN_FAILED if some computation failed
+    and NO_STEPS_AVAILABLE if the target can not be reached because some of the intermediate
+    targets are locked or not specified.
+    '''
+    if not scheme.target_exists(final_target_str):
+        return TARGET_NOT_FOUND
+    snapshot = scheme.status_snapshot()
+    if snapshot.is_done(final_target_str):
+        return TARGET_READY
+
+    # From here on the statuses of the targets we build are tracked in memory
+    (waiting_for, dependents, blocked) = collect_pending_targets(scheme, final_target_str, snapshot)
+    for b in blocked:
+        print "Target can not be built here (locked or unspecified): %s" % b
+    priorities = critical_path_priorities(scheme, final_target_str, snapshot) if critical_path else None
+    ready = ReadyQueue([t for t in waiting_for if waiting_for[t] == 0], priorities)
+    finished = Queue.Queue()
+    running = set()
+    completed = set()
+    deferred = dict()
+    streamed = dict()
+    failed = False
+    # Number of pending targets still needing the result of each target, for releasing results kept in memory
+    consumers = dict([(t, len(dependents[t])) for t in waiting_for])
+    release_result = getattr(computation_runner, 'release_result', None) if jobs == 1 else None
+    needed_elsewhere = set()
+    if release_result is not None and getattr(computation_runner, 'result_store', None) is not None:
+        for (k, ds) in dependent_targets(scheme).iteritems():
+            if k in waiting_for and len([d for d in ds if d not in waiting_for]) > 0:
+                needed_elsewhere.add(k)
+    # Number of pending targets needing each target done before, for collecting it once they are all done
+    done_consumers = dict()
+    if collector is not None:
+        for t in waiting_for:
+            for k in scheme.get_dependencies(t):
+                if k not in waiting_for:
+                    done_consumers[k] = done_consumers.get(k, 0) + 1
+
+    tasks = 0
+    io_tasks = 0
+
+    def claim(t):
+        # Marks the target as running, if it can be computed now
+        if t in completed or t in running:
+            return False
+        # Do not compute the same thing twice in parallel, wait for the running equivalent target instead
+        running_equivalent = [e for e in scheme.find_equivalent_targets(t) if e in running]
+        if len(running_equivalent) > 0:
+            deferred.setdefault(running_equivalent[0], []).append(t)
+            return False
+        running.add(t)
+        if pool is not None and is_stream_producer(scheme, computation_runner, t):
+            # Consumers of a streaming target read it while it is being computed
+            for d in dependents[t]:
+                if is_stream_consumer(scheme, d):
+                    streamed.setdefault(t, []).append(d)
+                    waiting_for[d] = waiting_for[d] - 1
+                    if waiting_for[d] == 0:
+                        ready.append(d)
+        return True
+
+    pool = None
+    # Batches given to the pool, by their first targets, and the batches the pool workers are computing, by PID
+    in_flight = dict()
+    workers = dict()
+    lost = []
+    if jobs > 1:
+        started = multiprocessing.queues.SimpleQueue()
+        pool = multiprocessing.Pool(jobs, _init_worker, (scheme, computation_runner, started))
+
+    def check_workers():
+        # The pool replaces a worker that died, but the batch it was computing is never finished
+        while not started.empty():
+            (pid, first) = started.get()
+            workers[pid] = first
+        alive = set([p.pid for p in pool._pool if p.exitcode is None])
+        for pid in [pid for pid in workers if pid not in alive]:
+            first = workers.pop(pid)
+            if first in in_flight and not in_flight[first][1].ready():
+                batch = in_flight[first][0]
+                lost.append(batch)
+                finished.put((batch, lost_batch_results(scheme, batch), False))
+    io_pool = None
+    if io_jobs > 0:
+        io_pool = multiprocessing.pool.ThreadPool(io_jobs)
+    try:
+        while len(ready) > 0 or len(running) > 0:
+            busy = []
+            while len(ready) > 0 and (tasks < jobs or io_tasks < io_jobs):
+                t = ready.popleft()
+                io = io_pool is not None and is_io_bound(scheme, computation_runner, t)
+                if (io and io_tasks >= io_jobs) or (not io and tasks >= jobs):
+                    busy.append(t)
+                    continue
+                if ledger is not None:
+                    request = target_resources(scheme, t)
+                    if not ledger.try_acquire(t, request):
+                        busy.append(t)
+                        continue
+                if not claim(t):
+                    if ledger is not None:
+                        ledger.release(t)
+                    continue
+                if io:
+                    io_tasks = io_tasks + 1
+                    io_pool.apply_async(compute_target, (scheme, computation_runner, t, jobs == 1, True),
+                                        callback=lambda result, t=t: finished.put(([t], [result], True)))
+                    continue
+                batch = [t]
+                # Consumers of a streaming target are started with it (see claim), so it must not wait for others in a batch
+                if batch_by == 'function' and not is_stream_producer(scheme, computation_runner, t):
+                    name = function_name(scheme, t)
+                    others = []
+                    scanned = 0
+                    while len(ready) > 0 and len(batch) < batch_size and scanned < 8*batch_size:
+                        u = ready.popleft()
+                        scanned = scanned + 1
+                        if function_name(scheme, u) != name or is_stream_producer(scheme, computation_runner, u) or \
+                           (ledger is not None and not needs_at_most(scheme, u, request)):
+                            others.append(u)
+                        elif claim(u):
+                            batch.append(u)
+                    ready.extend(others)
+                elif batch_by == 'chain':
+                    while len(batch) < batch_size and len(dependents[batch[-1]]) == 1:
+                        u = dependents[batch[-1]][0]
+                        if waiting_for[u] != 1 or is_stream_producer(scheme, computation_runner, u) or \
+                           (ledger is not None and not needs_at_most(scheme, u, request)) or not claim(u):
+                            break
+                        batch.append(u)
+                tasks = tasks + 1
+                if pool is None:
+                    finished.put((batch, compute_targets(scheme, computation_runner, batch, True), False))
+                else:
+                    in_flight[t] = (batch, pool.apply_async(_run_worker_batch, (batch,),
+                                                            callback=lambda results, batch=batch: finished.put((batch, results, False))))
+            ready.extend(busy)
+            # A timeout lets KeyboardInterrupt through while waiting, and dead workers are looked for meanwhile
+            while True:
+                try:
+                    (batch, results, io) = finished.get(True, 1.0)
+                    break
+                except Queue.Empty:
+                    if pool is not None:
+                        check_workers()
+            if pool is not None and not io and in_flight.pop(batch[0], None) is None:
+                continue    # Reported as lost already
+            if io:
+                io_tasks = io_tasks - 1
+            else:
+                tasks = tasks - 1
+            if ledger is not None:
+                ledger.release(batch[0])
+            for (t, result) in zip(batch, results):
+                running.remove(t)
+                if result is None:
+                    continue    # Skipped, as a target before it in the batch failed
+                if result != STEP_RUN_OK:
+                    failed = True
+                    ready.extend(deferred.pop(t, []))
+                    continue
+                # Equivalent targets waiting in the queue have received the shared output
+                newly_done = [t] + [e for e in scheme.find_equivalent_targets(t) if e in waiting_for and e not in running \
+                                    and e not in completed and scheme.is_done(e)]
+                ready.extend([e for e in deferred.pop(t, []) if e not in newly_done])
+                for c in newly_done:
+                    completed.add(c)
+                    if collector is not None:
+                        collector.completed(c)
+                    started_with = streamed.pop(c, [])
+                    for d in dependents[c]:
+                        if d in started_with:
+                            started_with.remove(d)
+                            continue
+                        waiting_for[d] = waiting_for[d] - 1
+                        # (Targets later in the same batch are already running)
+                        if waiting_for[d] == 0 and d not in running:
+                            ready.append(d)
+                if release_result is not None or collector is not None:
+                    for k in scheme.get_dependencies(t):
+                        if k in consumers:
+                            consumers[k] = consumers[k] - 1
+                            if consumers[k] == 0 and k != final_target_str:
+                                if release_result is not None:
+                                    if k in needed_elsewhere:
+                                        computation_runner.persist_result(k)
+                                    release_result(k)
+                                if collector is not None:
+                                    collector.consumed(k, completed)
+                        elif k in done_consumers:
+                            # Done before, possibly needed by targets outside of the computation
+                            done_consumers[k] = done_consumers[k] - 1
+                            if done_consumers[k] == 0:
+                                collector.consumed(k, completed)
+    except:
+        traceback.print_exc()
+        if pool is not None:
+            pool.terminate()
+            pool = None
+        if io_pool is not None:
+            io_pool.terminate()
+            io_pool = None
+        for t in running:
+            scheme.remove_target(t)
+            scheme.unlock_target(t, False)
+        raise
+    finally:
+        if pool is not None:
+            if len(lost) > 0:
+                # The pool would wait for the lost batches forever
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+        if io_pool is not None:
+            io_pool.close()
+            io_pool.join()
+        flush_results = getattr(computation_runner, 'flush_results', None)
+        if flush_results is not None:
+            flush_results()
+        sys.stdout.flush()
+
+    if scheme.is_done(final_target_str):
+        return STEP_RUN_OK
+    elif failed:
+        return STEP_RUN_FAILED
+    else:
+        return NO_STEPS_AVAILABLE
@@ -0,0 +1,78 @@
+'''
+PyCE: Computational experiment management framework.
+
+Manual test of I/O-bound computations
+Copyright 2010, Konstantin Tretyakov.
+Licensed under the BSD (3-clause) license.
+'''
+
+'''
+Fetches pages from a local HTTP server, which answers each request after a delay, with
+AsyncFunctionRunner, computing the fetches in threads of run_to_target (sharing a ResultStore):
+    $ python -m pyce.httptest [count] [io_jobs]
+Checks the fetched pages and that the fetches overlapped, i.e. took much less than count delays.
+'''
+
+import sys, time, shutil, cPickle, tempfile, threading, urllib2, BaseHTTPServer, SocketServer
+from computation import ComputationScheme
+from runner import AsyncFunctionRunner, ResultStore, io_bound
+from executor import run_to_target
+from util import STEP_RUN_OK
+
+DELAY = 0.5
+
+class SlowHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Answers each GET request with the requested path, after DELAY seconds.
+    '''
+    def do_GET(self):
+        time.sleep(DELAY)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.path)))
+        self.end_headers()
+        self.wfile.write(self.path)
+
+    def log_message(self, format, *args):
+        pass
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+@io_bound
+def fetch(url):
+    return urllib2.urlopen(url).read()
+
+def join(*pages):
+    return "\n".join(pages)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    io_jobs = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    server = ThreadingHTTPServer(('localhost', 0), SlowHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    cache_dir = tempfile.mkdtemp(prefix='pyce-httptest-')
+    try:
+        scheme = ComputationScheme(cache_dir)
+        saved, run = scheme.data_object, scheme.computation
+        for i in range(count):
+            saved._page[i] = run.pyce.httptest.fetch("http://localhost:%d/page/%d" % (server.server_address[1], i))
+        saved._all = run.pyce.httptest.join(*[saved._page[i] for i in range(count)])
+        start = time.time()
+        result = run_to_target(scheme, AsyncFunctionRunner(ResultStore()), str(saved._all), io_jobs=io_jobs)
+        elapsed = time.time() - start
+        assert result == STEP_RUN_OK, "The computation failed"
+        f = open(scheme.target_filename(str(saved._all)), 'rb')
+        pages = cPickle.load(f).split("\n")
+        f.close()
+        assert pages == ["/page/%d" % i for i in range(count)], "Wrong pages fetched"
+        print "Fetched %d pages in %.2f s (%.2f s each, %d at a time)" % (count, elapsed, DELAY, io_jobs)
+        assert io_jobs < 2 or elapsed < count * DELAY / 2, "The fetches did not overlap"
+        print "OK"
+    finally:
+        server.shutdown()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
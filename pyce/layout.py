@@ -0,0 +1,123 @@
+'''
+PyCE: Computational experiment management framework.
+
+Cache directory layouts
+Copyright 2010, Konstantin Tretyakov.
+Licensed under the BSD (3-clause) license.
+'''
+
+from urllib import quote
+import os, errno, hashlib
+
+# A layout decides where in the cache directory the output of each target is stored.
+# Names returned by cache_name are relative to the cache directory; the lock file
+# of the FileStateStore is the same name with ".locked" appended.
+
+class FlatLayout:
+    '''
+    The default layout: all outputs are stored directly in the cache directory,
+    under the URL-quoted target name.
+    '''
+    def cache_name(self, target_str):
+        return quote(target_str)
+
+    def list_cache(self, cache_dir):
+        '''
+        Returns the set of names (relative to cache_dir) of all files in the cache.
+        '''
+        try:
+            return set(os.listdir(cache_dir))
+        except OSError:
+            return set()
+
+    def prepare(self, cache_dir, target_str):
+        '''
+        Makes sure the output of the target can be created. Called before a target is locked.
+        '''
+        pass
+
+    def record(self, cache_dir, target_str):
+        '''
+        Called after a target has been locked successfully, i.e. its output is about to be created.
+        '''
+        pass
+
+class ShardedLayout:
+    '''
+    Stores each output under the SHA1 hash of the target name, in subdirectories named by
+    the first characters of the hash, e.g. cache_dir/3fa/3fa4c5...
+    This keeps directories small and file names short even for millions of targets.
+    The readable target names are kept in the index file (lines of "<hash>\\t<target>")
+    in the cache directory, which is appended to when a target not listed there is computed.
+
+    levels - number of nested subdirectory levels
+    width - number of hash characters used for each level
+    '''
+    INDEX_NAME = '.pyce-index'
+
+    def __init__(self, levels=1, width=3):
+        self.levels = levels
+        self.width = width
+        self.indexed = dict()   # cache_dir -> set of the hashes listed in its index, read on first use
+
+    def cache_name(self, target_str):
+        h = hashlib.sha1(target_str).hexdigest()
+        parts = [h[i*self.width:(i+1)*self.width] for i in range(self.levels)]
+        return os.path.join(*(parts + [h]))
+
+    def list_cache(self, cache_dir):
+        result = set()
+        for (dirpath, dirnames, filenames) in os.walk(cache_dir):
+            rel = os.path.relpath(dirpath, cache_dir)
+            if rel == '.':
+                continue
+            result.update([os.path.join(rel, f) for f in filenames])
+        return result
+
+    def prepare(self, cache_dir, target_str):
+        name = self.cache_name(target_str)
+        try:
+            os.makedirs(os.path.join(cache_dir, os.path.dirname(name)))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def record(self, cache_dir, target_str):
+        if cache_dir not in self.indexed:
+            self.indexed[cache_dir] = set(self.read_index(cache_dir))
+        h = os.path.basename(self.cache_name(target_str))
+        if h in self.indexed[cache_dir]:
+            return
+        f = open(os.path.join(cache_dir, self.INDEX_NAME), 'a')
+        f.write("%s\t%s\n" % (h, target_str))
+        f.close()
+        self.indexed[cache_dir].add(h)
+
+    def write_index(self, cache_dir, target_strs):
+        '''
+        Rewrites the index file to contain exactly the given targets.
+        '''
+        hashes = set()
+        f = open(os.path.join(cache_dir, self.INDEX_NAME), 'w')
+        for t in target_strs:
+            h = os.path.basename(self.cache_name(t))
+            if h not in hashes:
+                f.write("%s\t%s\n" % (h, t))
+                hashes.add(h)
+        f.close()
+        self.indexed[cache_dir] = hashes
+
+    def read_index(self, cache_dir):
+        '''
+        Returns a dict mapping hashes to target names.
+        '''
+        result = dict()
+        try:
+            f = open(os.path.join(cache_dir, self.INDEX_NAME))
+        except IOError:
+            return result
+        for line in f:
+            (h, t) = line.rstrip('\n').split('\t', 1)
+            result[h] = t
+        f.close()
+        return result
@@ -0,0 +1,126 @@
+'''
+PyCE: Computational experiment management framework.
+
+Resource-aware admission of computations
+Copyright 2010, Konstantin Tretyakov.
+Licensed under the BSD (3-clause) license.
+'''
+
+'''
+A computation may declare what it needs with the _resources keyword argument, e.g.
+    saved.model[i] = run.mod.train(saved.data, _resources=dict(memory=8, cores=4))
+where memory is in gigabytes. The argument is not passed to the function (see PythonFunctionRunner).
+Computations not declaring anything need one core and no memory.
+Parallel drivers start a computation only if the declared needs of all running computations together with it
+fit into the capacity of the machine (or the capacity given with the --memory and --cores options):
+* run_to_target keeps the account in memory (ResourceLedger),
+* computations started by make (with "makefile --resources") share it through a file in the cache
+  directory (FileResourceLedger): the compute action waits there until the computation fits.
+A computation is always admitted when nothing else is running, even if it needs more than the capacity.
+'''
+
+import os, time, json, errno, fcntl, multiprocessing
+
+DEFAULT_RESOURCES = dict(cores=1, memory=0)
+
+def machine_resources():
+    '''
+    Returns the capacity of the machine: the number of cores and the total memory in gigabytes.
+    '''
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / float(1 << 30)
+    return dict(cores=multiprocessing.cpu_count(), memory=memory)
+
+def target_resources(scheme, target_str):
+    '''
+    Returns the declared needs of the computation of the target.
+    '''
+    result = dict(DEFAULT_RESOURCES)
+    inv = scheme.find_invocation_for_target(target_str)
+    if inv is not None:
+        result.update(inv[1].special_kwarg('_resources', {}))
+    return result
+
+def fits(used, request, capacity):
+    '''
+    Tells whether request can be admitted when the needs of the running computations are the list used.
+    '''
+    if len(used) == 0:
+        return True
+    for k in capacity:
+        if sum([u.get(k, 0) for u in used]) + request.get(k, 0) > capacity[k]:
+            return False
+    return True
+
+class ResourceLedger:
+    '''
+    Account of the resources held by the computations of a single process (see run_to_target).
+    '''
+    def __init__(self, capacity=None):
+        self.capacity = capacity if capacity is not None else machine_resources()
+        self.held = dict()
+
+    def try_acquire(self, target_str, request):
+        if not fits(self.held.values(), request, self.capacity):
+            return False
+        self.held[target_str] = request
+        return True
+
+    def release(self, target_str):
+        self.held.pop(target_str, None)
+
+class FileResourceLedger:
+    '''
+    Account of the resources held by the computations of all processes on the machine, kept in the file
+    .pyce-resources in the cache directory (one JSON line [pid, target, request] per computation).
+    The file is locked with flock while it is updated. Entries of processes which no longer exist are dropped.
+    '''
+    NAME = '.pyce-resources'
+
+    def __init__(self, scheme, capacity=None, poll_interval=0.25):
+        self.filename = os.path.join(scheme.cache_dir, self.NAME)
+        self.capacity = capacity if capacity is not None else machine_resources()
+        self.poll_interval = poll_interval
+
+    def update(self, change):
+        '''
+        Calls change with the list of current entries; if it returns a list, it becomes the new content.
+        Returns True if the content was changed.
+        '''
+        f = open(self.filename, 'a+')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            f.seek(0)
+            entries = [json.loads(line) for line in f if line.strip() != '']
+            entries = [e for e in entries if process_exists(e[0])]
+            new_entries = change(entries)
+            if new_entries is None:
+                return False
+            f.seek(0)
+            f.truncate()
+            f.write("".join([json.dumps(e) + "\n" for e in new_entries]))
+            f.flush()
+            return True
+        finally:
+            f.close()
+
+    def acquire(self, target_str, request):
+        '''
+        Waits until the request fits and records it.
+        '''
+        entry = [os.getpid(), target_str, request]
+        waiting = False
+        while not self.update(lambda entries: entries + [entry] if fits([e[2] for e in entries], request, self.capacity) else None):
+            if not waiting:
+                print "Waiting for resources: %s" % target_str
+                waiting = True
+            time.sleep(self.poll_interval)
+
+    def release(self, target_str):
+        self.update(lambda entries: [e for e in entries if not (e[0] == os.getpid() and e[1] == target_str)])
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
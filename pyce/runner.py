@@ -6,7 +6,102 @@ Copyright 2010, Konstantin Tretyakov.
 Licensed under the BSD (3-clause) license.
 '''
 
+import sys, threading
+from collections import OrderedDict
 from computation import DataObjectDescriptor
+from serializers import get_serializer
+
+def estimate_size(value):
+    '''
+    Rough estimate of the memory taken by a value: its own size plus the sizes of its elements (one level deep).
+    '''
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        size = size + sum([sys.getsizeof(v) for v in value])
+    elif isinstance(value, dict):
+        size = size + sum([sys.getsizeof(k) + sys.getsizeof(v) for (k, v) in value.iteritems()])
+    return size
+
+MISSING = object()
+
+class ResultStore:
+    '''
+    Keeps the results of targets in memory, so that targets computed later in the same process
+    can use them directly (see PythonFunctionRunner). A result is written to its file
+    (with the given serializer, see serializers.py, pickled by default) only
+    * when it is stored with persist=True, or always, if write_through is set,
+    * when it is evicted: the estimated size of the kept results exceeds memory_budget (bytes)
+      and it is the least recently used one,
+    * when flush() or persist() is called.
+    A result which is not needed any more can be dropped with release() without being written at all.
+    Note that until a result is written, other processes do not consider its target done.
+    The store may be used from several threads (see AsyncFunctionRunner).
+    '''
+    def __init__(self, memory_budget=256*1024*1024, write_through=False):
+        self.memory_budget = memory_budget
+        self.write_through = write_through
+        self.entries = OrderedDict()   # target -> [value, size, filename, serializer, saved], least recently used first
+        self.size = 0
+        self.lock = threading.RLock()
+
+    def __contains__(self, target_str):
+        with self.lock:
+            return target_str in self.entries
+
+    def put(self, target_str, value, filename, persist=False, serializer=None):
+        if serializer is None:
+            serializer = get_serializer('pickle')
+        saved = persist or self.write_through
+        if saved:
+            serializer.save(value, filename)
+        size = estimate_size(value)
+        with self.lock:
+            self.release(target_str)
+            self.entries[target_str] = [value, size, filename, serializer, saved]
+            self.size = self.size + size
+            while self.size > self.memory_budget and len(self.entries) > 0:
+                self.evict(self.entries.iterkeys().next())
+
+    def get(self, target_str, *default):
+        '''
+        Returns the kept result of the target, or default (if given, like dict.pop) when there is none.
+        '''
+        with self.lock:
+            entry = self.entries.pop(target_str, None)
+            if entry is None:
+                if len(default) == 0:
+                    raise KeyError(target_str)
+                return default[0]
+            self.entries[target_str] = entry
+            return entry[0]
+
+    def evict(self, target_str):
+        with self.lock:
+            [value, size, filename, serializer, saved] = self.entries.pop(target_str)
+            self.size = self.size - size
+            if not saved:
+                serializer.save(value, filename)
+
+    def persist(self, target_str):
+        '''
+        Writes the result to its file now, if it is kept and not written yet. It stays in memory.
+        '''
+        with self.lock:
+            entry = self.entries.get(target_str)
+            if entry is not None and not entry[4]:
+                entry[3].save(entry[0], entry[2])
+                entry[4] = True
+
+    def release(self, target_str):
+        with self.lock:
+            entry = self.entries.pop(target_str, None)
+            if entry is not None:
+                self.size = self.size - entry[1]
+
+    def flush(self):
+        with self.lock:
+            while len(self.entries) > 0:
+                self.evict(self.entries.iterkeys().next())
 
 class ComputationRunnerInterface:
     '''
@@ -47,29 +142,154 @@ class PythonFunctionRunner(ComputationRunnerInterface):
         import do.something
         do.something.here(param1,param2,..., _output = dataobject[etc].etc),
     where all dataobject identifiers are transformed into strings representing the corresponding filenames.
-    The '_depend' keyword argument, if present, is removed from the argument list.
+    The '_depend', '_serializer', '_stream_consumer', '_resources' and '_pin' keyword arguments, if present, are removed from the argument list.
     Unless the name of the dataobject starts with _, the output filename is passed to the function
     via the _output parameter. Otherwise, the result of the function call is converted to
     string and written to the file.
+
+    The result may instead be saved with a serializer (see serializers.py), given by name either
+    in the _serializer keyword argument of the invocation (for any target), or, for _-prefixed targets,
+    for the function in the serializers dict (e.g. {'mod.compute': 'npy'}). Functions using such a target receive the loaded value
+    (e.g. a memory-mapped array) rather than the filename.
+
+    If a ResultStore is given, the results of _-prefixed targets are kept in it instead, and
+    functions receive these results themselves rather than the names of the files of
+    _-prefixed targets (the files, when written, contain pickled results unless another serializer is chosen).
+
+    Functions decorated with @batchable are called with lists of arguments, possibly for several
+    targets at once (see compute_batch).
     '''
+    def __init__(self, result_store=None, serializers=None):
+        self.result_store = result_store
+        self.serializers = serializers if serializers is not None else {}
+        self.batchable = dict()     # Function name -> whether it is @batchable, see batch_key
+
+    def serializer_name(self, target_str, computation):
+        '''
+        Returns the name of the serializer for the result of the target, or None if the function writes the output itself.
+        '''
+        name = computation.special_kwarg('_serializer')
+        if name is None and target_str.startswith('_'):
+            name = self.serializers.get(computation.name, 'pickle' if self.result_store is not None else 'str')
+        return name
+
     def compute_target(self, scheme, target_data_object, computation):
+        # Batchable functions always receive lists of arguments
+        if self.batch_key(str(target_data_object), computation) is not None:
+            return self.compute_batch(scheme, [(target_data_object, computation)])
         print "Building %s as %s" % (target_data_object, computation)
-        [target_function, args, kwargs, save_result_to_file, output_warning] = self.resolve_compute_target(scheme, target_data_object, computation)
+        [target_function, args, kwargs, save_result_to_file, output_warning] = \
+            self.resolve_compute_target(scheme, target_data_object, computation, self.load_result)
         if (target_function is None):
             raise Exception("Could not import requested function/package")
         result = target_function(*args, **kwargs)
         if save_result_to_file is not None:
-            with open(save_result_to_file, 'w') as outfile:
-                outfile.write(str(result))
+            self.save_result(scheme, target_data_object, computation, result, save_result_to_file)
         return True
 
+    def save_result(self, scheme, target_data_object, computation, result, filename):
+        serializer = get_serializer(self.serializer_name(str(target_data_object), computation))
+        if self.result_store is not None and not getattr(serializer, 'streams', False):
+            persist = scheme.main_target is not None and str(scheme.main_target) == str(target_data_object)
+            self.result_store.put(str(target_data_object), result, filename, persist, serializer)
+        else:
+            serializer.save(result, filename)
+
+    def batch_key(self, target_str, computation):
+        '''
+        Returns None if the target can not be computed in a batch (see compute_batch), otherwise a key,
+        equal for the targets which can be computed together: those of the same @batchable function,
+        with the same numbers of arguments and the same keyword arguments, saved in the same way.
+        '''
+        batchable = self.batchable.get(computation.name)
+        if batchable is None:
+            try:
+                batchable = bool(getattr(self.import_function(computation.name), 'pyce_batchable', False))
+            except (ImportError, AttributeError, KeyError):
+                batchable = False   # Reported when the target is computed
+            self.batchable[computation.name] = batchable
+        if not batchable:
+            return None
+        serializer = self.serializer_name(target_str, computation)
+        if serializer is not None and getattr(get_serializer(serializer), 'streams', False):
+            return None
+        return (computation.name, target_str.startswith('_'), serializer,
+                len(computation.args or []), tuple(sorted(computation.kwargs or [])))
+
+    def compute_batch(self, scheme, invocations):
+        '''
+        Computes several targets with equal batch keys (see batch_key) with a single call of their function.
+        The function receives a list of values in place of each argument (the i-th value for the i-th target)
+        and, for _-prefixed targets, must return a list with the result of each target.
+        Batchable functions are called this way (with lists of one element) also for single targets.
+        invocations - list of pairs (target_data_object, computation).
+        '''
+        print "Building %d targets as %s in a batch" % (len(invocations), invocations[0][1].name)
+        resolved = [self.resolve_compute_target(scheme, obj, comp, self.load_result) for (obj, comp) in invocations]
+        target_function = resolved[0][0]
+        if (target_function is None):
+            raise Exception("Could not import requested function/package")
+        args = [list(a) for a in zip(*[r[1] for r in resolved])]
+        kwargs = dict([(k, [r[2][k] for r in resolved]) for k in resolved[0][2]])
+        results = target_function(*args, **kwargs)
+        if resolved[0][3] is not None:
+            results = list(results)
+            if len(results) != len(invocations):
+                raise Exception("%s returned %d results for %d targets" % (invocations[0][1].name, len(results), len(invocations)))
+            for ((obj, comp), r, result) in zip(invocations, resolved, results):
+                self.save_result(scheme, obj, comp, result, r[3])
+        return True
+
+    def load_result(self, scheme, data_object):
+        '''
+        Returns (True, result) for a target whose result is saved by a serializer which can load it,
+        taking the result from memory (with a result store) or from its file.
+        Returns (False, None) otherwise, the filename is then used instead.
+        '''
+        target_str = str(data_object)
+        if self.result_store is not None:
+            # A single lookup, the result may be evicted by another thread at any time
+            value = self.result_store.get(target_str, MISSING)
+            if value is not MISSING:
+                return (True, value)
+        invocation = scheme.find_invocation_for_target(target_str)
+        name = self.serializer_name(target_str, invocation[1]) if invocation is not None else None
+        if name is None or not get_serializer(name).loads:
+            return (False, None)
+        serializer = get_serializer(name)
+        if getattr(serializer, 'streams', False):
+            # The target may still be being computed
+            return (True, serializer.load(scheme.target_filename(target_str), lambda: scheme.is_locked(target_str)))
+        return (True, serializer.load(scheme.target_filename(target_str)))
+
+    def release_result(self, target_str):
+        '''
+        Tells the runner that the result of the target will not be needed any more.
+        '''
+        if self.result_store is not None:
+            self.result_store.release(target_str)
+
+    def persist_result(self, target_str):
+        '''
+        Makes sure the result of the target is written to its file, so that other processes can use it.
+        '''
+        if self.result_store is not None:
+            self.result_store.persist(target_str)
+
+    def flush_results(self):
+        '''
+        Writes all results kept in memory to their files.
+        '''
+        if self.result_store is not None:
+            self.result_store.flush()
+
     def describe_compute_target(self, scheme, target_data_object, computation):
         [target_function, args, kwargs, save_result_to_file, output_warning] = self.resolve_compute_target(scheme, target_data_object, computation)
         args = map(repr, args)
         kwargs = map(lambda (x,y): '%s=%s' % (str(x), repr(y)), kwargs.iteritems())
         result = '%s(%s)' % (computation.name, ', '.join(args + kwargs))
         if save_result_to_file is not None:
-            result = result +'\nOUTPUT SAVED TO: %s' % save_result_to_file
+            result = result +'\nOUTPUT SAVED TO: %s (%s)' % (save_result_to_file, self.serializer_name(str(target_data_object), computation))
         if target_function is None:
             result = result + '\nERROR: Function %s could not be resolved!' % computation.name
         if output_warning:
@@ -77,7 +297,7 @@ class PythonFunctionRunner(ComputationRunnerInterface):
         return result
 
     @staticmethod
-    def resolve_compute_target(scheme, target_data_object, computation):
+    def resolve_compute_target(scheme, target_data_object, computation, load_result=None):
         '''
         Given a target data object and a computation to be performed, finds a function, and a set of parameters
         required to compute it. Used both by compute_target and describe_compute_target.
@@ -87,6 +307,7 @@ class PythonFunctionRunner(ComputationRunnerInterface):
         * save_result_to_file is None if nothing has to be saved, and a name of the file to save function output to otherwise.
         * output_warning is True if the invocation had originally specified an _output parameter which will be
         replaced on actual invocation.
+        load_result, if given, is used to obtain the values of arguments (see replace_targets_with_filenames).
         '''
         output_warning = False
         try:
@@ -95,7 +316,8 @@ class PythonFunctionRunner(ComputationRunnerInterface):
             import traceback
             traceback.print_exc()
             target_function = None
-        kwargs = computation.kwargs if computation.kwargs is not None else {}
+        # Copy the keyword arguments, the computation itself must stay unchanged
+        kwargs = dict(computation.kwargs) if computation.kwargs is not None else {}
         args   = computation.args   if computation.args   is not None else []
 
         # if target_data_object's name starts with _, we do not pass the
@@ -104,6 +326,15 @@ class PythonFunctionRunner(ComputationRunnerInterface):
 
         if '_depend' in kwargs:
             del kwargs['_depend']
+        if '_serializer' in kwargs:
+            del kwargs['_serializer']
+            have_output_param = False
+        if '_stream_consumer' in kwargs:
+            del kwargs['_stream_consumer']
+        if '_resources' in kwargs:
+            del kwargs['_resources']
+        if '_pin' in kwargs:
+            del kwargs['_pin']
         if ('_output' in kwargs) and have_output_param:
             output_warning = True
         if have_output_param:
@@ -112,27 +343,32 @@ class PythonFunctionRunner(ComputationRunnerInterface):
         else:
             save_result_to_file = scheme.target_filename(target_data_object)
 
-        kwargs = PythonFunctionRunner.replace_targets_with_filenames(scheme, kwargs)
-        args   = PythonFunctionRunner.replace_targets_with_filenames(scheme, args)
+        kwargs = PythonFunctionRunner.replace_targets_with_filenames(scheme, kwargs, load_result)
+        args   = PythonFunctionRunner.replace_targets_with_filenames(scheme, args, load_result)
         return [target_function, args, kwargs, save_result_to_file, output_warning]
 
     # TODO: May get stuck in an infinite loop when given bad input with self-recursion.
     @staticmethod
-    def replace_targets_with_filenames(scheme, obj):
+    def replace_targets_with_filenames(scheme, obj, load_result=None):
         '''
         If the given object is a DataObjectDescriptor, replaces it with its filename.
+        (If load_result is given and load_result(scheme, obj) returns (True, value), with the value instead.)
         If the given object is a list or a dict, descends recursively.
         Otherwise returns the object without changes.
         '''
         if obj is None:
             return None
         elif isinstance(obj, DataObjectDescriptor):
+            if load_result is not None:
+                (found, value) = load_result(scheme, obj)
+                if found:
+                    return value
             return scheme.target_filename(obj)
         elif isinstance(obj, list) or isinstance(obj, tuple):
-            return map(lambda x: PythonFunctionRunner.replace_targets_with_filenames(scheme, x), obj)
+            return map(lambda x: PythonFunctionRunner.replace_targets_with_filenames(scheme, x, load_result), obj)
         elif isinstance(obj, dict):
             for k in obj:
-                obj[k] = PythonFunctionRunner.replace_targets_with_filenames(scheme, obj[k])
+                obj[k] = PythonFunctionRunner.replace_targets_with_filenames(scheme, obj[k], load_result)
             return obj
         else:
             return obj
@@ -152,5 +388,43 @@ class PythonFunctionRunner(ComputationRunnerInterface):
             f = getattr(m, path[-1])
         return f
 
+def batchable(function):
+    '''
+    Decorator marking a function which can compute many targets in one call (see PythonFunctionRunner.compute_batch).
+    '''
+    function.pyce_batchable = True
+    return function
+
+def io_bound(function):
+    '''
+    Decorator marking a function as spending most of its time waiting for I/O (see AsyncFunctionRunner).
+    '''
+    function.pyce_io_bound = True
+    return function
+
+class AsyncFunctionRunner(PythonFunctionRunner):
+    '''
+    A PythonFunctionRunner which tells I/O-bound computations apart: those of functions decorated
+    with @io_bound or listed in io_functions (by their full names).
+    The executor (see run_to_target and the --io-jobs option of the run action) computes the targets
+    of such functions in threads of the current process, many at once, instead of worker processes.
+    The functions must thus be thread-safe.
+    '''
+    def __init__(self, result_store=None, serializers=None, io_functions=None):
+        PythonFunctionRunner.__init__(self, result_store, serializers)
+        self.io_functions = set(io_functions or [])
+        self.io_bound = dict()      # Function name -> whether it is I/O-bound, see is_io_bound
+
+    def is_io_bound(self, computation):
+        io_bound = self.io_bound.get(computation.name)
+        if io_bound is None:
+            try:
+                io_bound = computation.name in self.io_functions or \
+                           bool(getattr(self.import_function(computation.name), 'pyce_io_bound', False))
+            except (ImportError, AttributeError, KeyError):
+                io_bound = False    # Reported when the target is computed
+            self.io_bound[computation.name] = io_bound
+        return io_bound
+
 SYSTEM_RUNNER = ComputationRunner()
 PYTHON_RUNNER = PythonFunctionRunner()
@@ -0,0 +1,226 @@
+'''
+PyCE: Computational experiment management framework.
+
+Result serializers
+Copyright 2010, Konstantin Tretyakov.
+Licensed under the BSD (3-clause) license.
+'''
+
+'''
+A serializer saves the value returned by a function to the output file of a target
+and loads it back for the functions that use the target.
+PythonFunctionRunner chooses the serializer of a target by name: from the _serializer
+keyword argument of its invocation, e.g.
+    saved._x = run.mod.compute(..., _serializer='npy')
+or from the serializers given to the runner for each function.
+Serializers are found by name in SERIALIZERS, new ones are added with register_serializer.
+
+Targets saved with the 'stream' serializer are streaming targets. A function using such a target
+receives an iterable over its chunks; if its invocation has the _stream_consumer=True keyword argument,
+the parallel executor (see executor.py) starts it as soon as the streaming target is started,
+and the iteration then follows the output while it is being written.
+'''
+
+import os, time, struct, cPickle
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class StrSerializer:
+    '''
+    Writes str(value). The output can not be loaded back,
+    functions using such a target receive the name of its file.
+    '''
+    loads = False
+
+    def save(self, value, filename):
+        f = open(filename, 'w')
+        try:
+            f.write(str(value))
+        finally:
+            f.close()
+
+    def load(self, filename):
+        return filename
+
+class PickleSerializer:
+    '''
+    Pickles the value with the highest available protocol.
+    '''
+    loads = True
+
+    def save(self, value, filename):
+        f = open(filename, 'wb')
+        try:
+            cPickle.dump(value, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+
+    def load(self, filename):
+        f = open(filename, 'rb')
+        try:
+            return cPickle.load(f)
+        finally:
+            f.close()
+
+class NumpySerializer:
+    '''
+    Saves a numpy array in the .npy format. Loaded arrays are read-only memory-mapped views of
+    the file, so that nothing is copied until the data is actually used.
+    Requires numpy.
+    '''
+    loads = True
+
+    def save(self, value, filename):
+        if numpy is None:
+            raise Exception("The npy serializer requires numpy")
+        # Passing a file object keeps numpy from appending the .npy extension
+        f = open(filename, 'wb')
+        try:
+            numpy.save(f, numpy.asanyarray(value))
+        finally:
+            f.close()
+
+    def load(self, filename):
+        if numpy is None:
+            raise Exception("The npy serializer requires numpy")
+        return numpy.load(filename, mmap_mode='r')
+
+class RawArraySerializer:
+    '''
+    Writes the raw contents of a buffer (an array.array or a contiguous numpy array) with elements
+    of the given type (an array module typecode, e.g. 'd'). Values with other element types are converted.
+    Loads a read-only numpy.memmap if numpy is available, and an array.array otherwise.
+    '''
+    loads = True
+
+    def __init__(self, typecode='d'):
+        self.typecode = typecode
+
+    def save(self, value, filename):
+        if numpy is not None and isinstance(value, numpy.ndarray):
+            value = numpy.ascontiguousarray(value, dtype=self.typecode)
+        elif not isinstance(value, array) or value.typecode != self.typecode:
+            value = array(self.typecode, value)
+        f = open(filename, 'wb')
+        try:
+            f.write(buffer(value))
+        finally:
+            f.close()
+
+    def load(self, filename):
+        size = os.path.getsize(filename)
+        if size % array(self.typecode).itemsize != 0:
+            raise Exception("The size of %s is not a multiple of the size of its elements ('%s')" % (filename, self.typecode))
+        if numpy is not None:
+            if size == 0:
+                return numpy.zeros(0, dtype=self.typecode)
+            return numpy.memmap(filename, dtype=self.typecode, mode='r')
+        result = array(self.typecode)
+        f = open(filename, 'rb')
+        try:
+            result.fromfile(f, size / result.itemsize)
+        finally:
+            f.close()
+        return result
+
+class StreamSerializer:
+    '''
+    For functions returning an iterable (e.g. a generator) of chunks. Each chunk is pickled and
+    appended to the output as soon as it is produced, so that consumers may read the chunks while
+    the target is still being computed (see StreamReader).
+    The output is a sequence of records, each a 64-bit length followed by a pickled chunk,
+    terminated by a record of length -1.
+    '''
+    loads = True
+    streams = True
+    HEADER = struct.Struct('>q')
+
+    def save(self, value, filename):
+        f = open(filename, 'wb')
+        try:
+            for chunk in value:
+                data = cPickle.dumps(chunk, cPickle.HIGHEST_PROTOCOL)
+                f.write(self.HEADER.pack(len(data)))
+                f.write(data)
+                f.flush()
+            f.write(self.HEADER.pack(-1))
+        finally:
+            f.close()
+
+    def load(self, filename, is_running=None):
+        return StreamReader(filename, is_running)
+
+class StreamReader:
+    '''
+    Iterates over the chunks of an output written by StreamSerializer.
+    is_running - function telling whether the target is still being computed. While it is,
+    the reader waits for more chunks (polling every poll_interval seconds), otherwise a missing
+    or incomplete output raises an exception.
+    A consumer may be started just before its producer (see run_to_target), so a missing output
+    is waited for during start_timeout seconds even if the target is not being computed.
+    '''
+    def __init__(self, filename, is_running=None, poll_interval=0.1, start_timeout=30.0):
+        self.filename = filename
+        self.is_running = is_running
+        self.poll_interval = poll_interval
+        self.start_timeout = start_timeout
+
+    def running(self):
+        return self.is_running is not None and self.is_running()
+
+    def __iter__(self):
+        deadline = time.time() + self.start_timeout
+        while not os.path.exists(self.filename):
+            if not self.running() and time.time() > deadline and not os.path.exists(self.filename):
+                raise Exception("Stream not found: %s" % self.filename)
+            time.sleep(self.poll_interval)
+        f = open(self.filename, 'rb')
+        try:
+            while True:
+                (length,) = StreamSerializer.HEADER.unpack(self.read(f, StreamSerializer.HEADER.size))
+                if length < 0:
+                    return
+                yield cPickle.loads(self.read(f, length))
+        finally:
+            f.close()
+
+    def read(self, f, n):
+        pos = f.tell()
+        while True:
+            data = f.read(n)
+            if len(data) == n:
+                return data
+            # Seeking back also clears the end-of-file condition of the file
+            f.seek(pos)
+            if not self.running():
+                # The producer has finished, so whatever it wrote is there now
+                data = f.read(n)
+                if len(data) == n:
+                    return data
+                raise Exception("Incomplete stream: %s" % self.filename)
+            time.sleep(self.poll_interval)
+
+SERIALIZERS = {
+    'str': StrSerializer(),
+    'pickle': PickleSerializer(),
+    'npy': NumpySerializer(),
+    'raw': RawArraySerializer('d'),
+    'stream': StreamSerializer(),
+}
+
+def register_serializer(name, serializer):
+    '''
+    Makes the serializer available under the given name. A serializer has the methods
+    save(value, filename) and load(filename) and the attribute loads, which is False if the
+    functions using the target should receive its filename rather than the loaded value.
+    '''
+    SERIALIZERS[name] = serializer
+
+def get_serializer(name):
+    if name not in SERIALIZERS:
+        raise Exception("Unknown serializer: %s" % name)
+    return SERIALIZERS[name]
@@ -0,0 +1,120 @@
+'''
+PyCE: Computational experiment management framework.
+
+Fork-server for computing targets
+Copyright 2010, Konstantin Tretyakov.
+Licensed under the BSD (3-clause) license.
+'''
+
+'''
+The server is started with the "serve" action. It builds the scheme and imports the modules
+of all computations once, then listens on a Unix socket. For each request it forks a worker
+that computes the requested target with compute_target and sends the output back.
+Requests are sent by client.py, e.g. from Makefile rules generated with "makefile --socket".
+'''
+
+import os, sys, errno, socket, signal, threading, traceback
+from util import compute_target, COMPUTE_TARGET_RESULT_MSG
+from client import send_message, MESSAGE_OUTPUT, MESSAGE_RESULT
+
+CLIENT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'client.py')
+
+def client_command(socket_path):
+    '''
+    Returns the shell command which computes a target (given as an extra argument) using the server.
+    '''
+    return '"%s" "%s" "%s"' % (sys.executable, CLIENT_SCRIPT, socket_path)
+
+def preload_functions(scheme, computation_runner):
+    '''
+    Imports the functions of all computations of the scheme, if the runner knows how to (i.e. has import_function),
+    so that the forked workers find the modules already loaded.
+    '''
+    if not hasattr(computation_runner, 'import_function'):
+        return
+    names = set()
+    for (obj, comp) in scheme.iter_invocations():
+        names.add(comp.name)
+    for name in names:
+        try:
+            computation_runner.import_function(name)
+        except:
+            print "Could not preload %s" % name
+
+def serve(scheme, computation_runner, socket_path):
+    '''
+    Serves requests on the given Unix socket until interrupted.
+    '''
+    preload_functions(scheme, computation_runner)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(128)
+    # Finished workers are reaped automatically, termination removes the socket
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print "Serving on %s" % socket_path
+    sys.stdout.flush()
+    try:
+        while True:
+            try:
+                (conn, addr) = server.accept()
+            except socket.error, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            sys.stdout.flush()
+            pid = os.fork()
+            if pid == 0:
+                server.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                _serve_request(scheme, computation_runner, conn)
+            conn.close()
+    finally:
+        server.close()
+        os.unlink(socket_path)
+
+def _relay_output(fd, conn):
+    # Sends everything written to the pipe as output messages (see client.py)
+    while True:
+        data = os.read(fd, 65536)
+        if not data:
+            break
+        send_message(conn, MESSAGE_OUTPUT, data)
+    os.close(fd)
+
+def _serve_request(scheme, computation_runner, conn):
+    # Runs in the forked worker, never returns
+    try:
+        f = conn.makefile('r')
+        target_str = f.readline().rstrip("\n")
+        f.close()
+        # The output of the computation (and of its subprocesses) goes through a pipe to the relay thread
+        (r, w) = os.pipe()
+        relay = threading.Thread(target=_relay_output, args=(r, conn))
+        relay.start()
+        os.dup2(w, 1)
+        os.dup2(w, 2)
+        os.close(w)
+        try:
+            result = compute_target(scheme, computation_runner, target_str)
+            print "Result: " + COMPUTE_TARGET_RESULT_MSG[result]
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            # Closing the write end of the pipe ends the relay
+            null = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(null, 1)
+            os.dup2(null, 2)
+            os.close(null)
+            relay.join()
+        send_message(conn, MESSAGE_RESULT, "%d" % result)
+    except:
+        try:
+            send_message(conn, MESSAGE_OUTPUT, traceback.format_exc())
+        except:
+            pass
+    finally:
+        os._exit(0)
@@ -0,0 +1,200 @@
+'''
+PyCE: Computational experiment management framework.
+
+Target state bookkeeping
+Copyright 2010, Konstantin Tretyakov.
+Licensed under the BSD (3-clause) license.
+'''
+
+import os, errno, socket, time, sqlite3, threading
+
+# Possible return values of ComputationScheme.target_status
+TARGET_STATUS_NONE = 0
+TARGET_STATUS_LOCKED = 1
+TARGET_STATUS_DONE = 2
+
+# An output compressed by the garbage collector (see collector.py) is stored under its name with this suffix.
+# The target is still considered done.
+COMPRESSED_SUFFIX = '.pyce-gz'
+
+class StatusSnapshot:
+    '''
+    Statuses of the targets of a scheme, as seen by a single listing of the cache directory.
+    Provides the target_status, is_locked and is_done methods of ComputationScheme,
+    but answers them from memory. Use it whenever statuses of many targets are needed.
+    The snapshot does not change by itself, call refresh() to take a new listing.
+    '''
+    def __init__(self, scheme):
+        self.scheme = scheme
+        self.refresh()
+
+    def refresh(self):
+        self.present = self.scheme.layout.list_cache(self.scheme.cache_dir)
+
+    def target_status(self, target_str):
+        name = self.scheme.target_cache_name(target_str)
+        if name + ".locked" in self.present:
+            return TARGET_STATUS_LOCKED
+        elif name in self.present or name + COMPRESSED_SUFFIX in self.present:
+            return TARGET_STATUS_DONE
+        else:
+            return TARGET_STATUS_NONE
+
+    def is_locked(self, target_str):
+        return self.target_status(target_str) == TARGET_STATUS_LOCKED
+
+    def is_done(self, target_str):
+        return self.target_status(target_str) == TARGET_STATUS_DONE
+
+
+class SQLiteStatusSnapshot(StatusSnapshot):
+    '''
+    StatusSnapshot for the SQLiteStateStore: output files are taken from a listing of the
+    cache directory, locked targets from a single query to the database.
+    '''
+    def __init__(self, scheme, store):
+        self.store = store
+        StatusSnapshot.__init__(self, scheme)
+
+    def refresh(self):
+        StatusSnapshot.refresh(self)
+        self.locked = self.store.locked_targets(self.scheme)
+
+    def target_status(self, target_str):
+        if target_str in self.locked:
+            return TARGET_STATUS_LOCKED
+        elif self.scheme.target_cache_name(target_str) in self.present or \
+             self.scheme.target_cache_name(target_str) + COMPRESSED_SUFFIX in self.present:
+            return TARGET_STATUS_DONE
+        else:
+            return TARGET_STATUS_NONE
+
+# -------------- State stores -----------------
+# A state store keeps track of which targets are being computed. The ComputationScheme
+# delegates target_status, lock_target, unlock_target and status_snapshot to it.
+# A target is considered done when its output file exists and it is not locked.
+
+class FileStateStore:
+    '''
+    The default state store. A target is locked while the file <target file>.locked exists.
+    The lock file is created atomically and contains the PID of the process owning the lock.
+    '''
+    def target_status(self, scheme, target_str):
+        filename = scheme.target_filename(target_str)
+        if os.path.exists(filename + ".locked"):
+            return TARGET_STATUS_LOCKED
+        elif os.path.exists(filename) or os.path.exists(filename + COMPRESSED_SUFFIX):
+            return TARGET_STATUS_DONE
+        else:
+            return TARGET_STATUS_NONE
+
+    def lock_target(self, scheme, target_str):
+        try:
+            fd = os.open(scheme.target_filename(target_str) + ".locked", os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+        os.write(fd, str(os.getpid()))
+        os.close(fd)
+        return True
+
+    def unlock_target(self, scheme, target_str, success=None):
+        if os.path.exists(scheme.target_filename(target_str) + ".locked"):
+            os.unlink(scheme.target_filename(target_str) + ".locked")
+
+    def status_snapshot(self, scheme):
+        return StatusSnapshot(scheme)
+
+class SQLiteStateStore:
+    '''
+    Keeps the state of all targets in a single SQLite database instead of .locked files.
+    For each target it records the status ('running', 'done' or 'failed'), the PID and host of
+    the process that claimed it, and the start and end times of the last computation.
+    A target is locked while its status is 'running'. Claiming a target is a single transaction,
+    so concurrent processes can not both obtain the same target. Unlocking a target without telling
+    whether it was computed (e.g. after gc or "outdated --invalidate") restores the record it had before.
+
+    filename - the database file, by default .pyce-state.sqlite in the cache directory
+    timeout - how many seconds to wait for a database locked by another process
+    '''
+    def __init__(self, filename=None, timeout=60.0):
+        self.filename = filename
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connect(self, scheme):
+        # SQLite connections must not be shared with forked children or other threads
+        local = self.local
+        if getattr(local, 'connection', None) is None or local.pid != os.getpid():
+            filename = self.filename
+            if filename is None:
+                filename = os.path.join(scheme.cache_dir, ".pyce-state.sqlite")
+            local.connection = sqlite3.connect(filename, timeout=self.timeout, isolation_level=None)
+            local.pid = os.getpid()
+            local.connection.execute('''CREATE TABLE IF NOT EXISTS targets (
+                target TEXT PRIMARY KEY, status TEXT NOT NULL,
+                pid INTEGER, host TEXT, started REAL, finished REAL)''')
+        return local.connection
+
+    def target_status(self, scheme, target_str):
+        row = self.connect(scheme).execute("SELECT status FROM targets WHERE target = ?", (target_str,)).fetchone()
+        if row is not None and row[0] == 'running':
+            return TARGET_STATUS_LOCKED
+        elif os.path.exists(scheme.target_filename(target_str)) or os.path.exists(scheme.target_filename(target_str) + COMPRESSED_SUFFIX):
+            return TARGET_STATUS_DONE
+        else:
+            return TARGET_STATUS_NONE
+
+    def lock_target(self, scheme, target_str):
+        db = self.connect(scheme)
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT status, pid, host, started, finished FROM targets WHERE target = ?", (target_str,)).fetchone()
+            if row is not None and row[0] == 'running':
+                db.execute("ROLLBACK")
+                return False
+            self.previous_records()[target_str] = row
+            db.execute("INSERT OR REPLACE INTO targets (target, status, pid, host, started, finished) VALUES (?, 'running', ?, ?, ?, NULL)",
+                       (target_str, os.getpid(), socket.gethostname(), time.time()))
+            db.execute("COMMIT")
+            return True
+        except:
+            db.execute("ROLLBACK")
+            raise
+
+    def previous_records(self):
+        # Records of the targets locked by this thread, as they were before, see unlock_target
+        if getattr(self.local, 'previous', None) is None:
+            self.local.previous = dict()
+        return self.local.previous
+
+    def unlock_target(self, scheme, target_str, success=None):
+        records = self.previous_records()
+        known = target_str in records
+        previous = records.pop(target_str, None)
+        db = self.connect(scheme)
+        if success is None and not known:
+            # Locked by another process, the status is told by the output
+            success = os.path.exists(scheme.target_filename(target_str)) or os.path.exists(scheme.target_filename(target_str) + COMPRESSED_SUFFIX)
+        if success is not None:
+            db.execute("UPDATE targets SET status = ?, finished = ? WHERE target = ? AND status = 'running'",
+                       ('done' if success else 'failed', time.time(), target_str))
+        elif previous is not None:
+            db.execute("UPDATE targets SET status = ?, pid = ?, host = ?, started = ?, finished = ? WHERE target = ? AND status = 'running'",
+                       tuple(previous) + (target_str,))
+        else:
+            db.execute("DELETE FROM targets WHERE target = ? AND status = 'running'", (target_str,))
+
+    def locked_targets(self, scheme):
+        return set([r[0] for r in self.connect(scheme).execute("SELECT target FROM targets WHERE status = 'running'")])
+
+    def all_statuses(self, scheme):
+        '''
+        Returns a dict mapping each recorded target to a tuple (status, pid, host, started, finished).
+        '''
+        rows = self.connect(scheme).execute("SELECT target, status, pid, host, started, finished FROM targets")
+        return dict([(r[0], r[1:]) for r in rows])
+
+    def status_snapshot(self, scheme):
+        return SQLiteStatusSnapshot(scheme, self)
@@ -0,0 +1,262 @@
+'''
+PyCE: Computational experiment management framework.
+
+Execution telemetry
+Copyright 2010, Konstantin Tretyakov.
+Licensed under the BSD (3-clause) license.
+'''
+
+'''
+compute_target (see util.py) measures each computation and appends a record to the metrics
+file in the cache directory, one JSON object per line:
+    target, function, result, started, wall, cpu (seconds), maxrss (kilobytes, peak RSS of the
+    computing process so far), read_bytes, write_bytes (as counted in /proc/self/io, 0 where unavailable),
+    output_size (bytes, 0 if there is no output file).
+For computations run in threads (see AsyncFunctionRunner), cpu, maxrss, read_bytes and write_bytes are null,
+as the counters are shared by all threads of the process, and threaded is true.
+The "profile" action summarizes these records (see print_profile).
+With the --critical-path option, the recorded durations are also used to compute first the targets
+on the longest remaining paths (see critical_path_priorities).
+'''
+
+import os, time, json, resource
+from state import TARGET_STATUS_DONE
+
+METRICS_NAME = '.pyce-metrics'
+
+def read_io_counters():
+    '''
+    Returns the numbers of bytes read and written by the current process so far, or (0, 0) if unknown.
+    '''
+    try:
+        f = open('/proc/self/io')
+    except IOError:
+        return (0, 0)
+    counters = dict()
+    for line in f:
+        (name, value) = line.split(':', 1)
+        counters[name] = int(value)
+    f.close()
+    return (counters.get('rchar', 0), counters.get('wchar', 0))
+
+def start_measurement():
+    '''
+    Returns an object to be passed to finish_measurement after the computation.
+    '''
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return (time.time(), usage.ru_utime + usage.ru_stime, read_io_counters())
+
+def finish_measurement(start, scheme, target_str, function_name, result, threaded=False):
+    '''
+    Returns the metrics record of a computation started with start_measurement.
+    threaded - the computation ran in a thread, concurrently with others: only the wall time is its own.
+    '''
+    (started, cpu, (read_bytes, write_bytes)) = start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    (read_now, write_now) = read_io_counters()
+    filename = scheme.target_filename(target_str)
+    record = dict(target=target_str, function=function_name, result=result, started=started,
+                  wall=time.time() - started, cpu=usage.ru_utime + usage.ru_stime - cpu, maxrss=usage.ru_maxrss,
+                  read_bytes=read_now - read_bytes, write_bytes=write_now - write_bytes,
+                  output_size=os.path.getsize(filename) if os.path.isfile(filename) else 0)
+    if threaded:
+        record.update(cpu=None, maxrss=None, read_bytes=None, write_bytes=None, threaded=True)
+    return record
+
+def format_metric(value, format, width):
+    # Metrics not available for a computation are shown as -
+    return (format % value) if value is not None else '-'.rjust(width)
+
+def record_metrics(scheme, record):
+    '''
+    Appends the record to the metrics file. Each record is written with a single write
+    to a file opened for appending, so that concurrent computations do not mix their records.
+    '''
+    fd = os.open(os.path.join(scheme.cache_dir, METRICS_NAME), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.write(fd, json.dumps(record) + "\n")
+    finally:
+        os.close(fd)
+
+def read_metrics(scheme):
+    '''
+    Returns a dict mapping each target to its latest metrics record.
+    '''
+    result = dict()
+    try:
+        f = open(os.path.join(scheme.cache_dir, METRICS_NAME))
+    except IOError:
+        return result
+    for line in f:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue    # A record being written
+        result[record['target']] = record
+    f.close()
+    return result
+
+def dependency_closure(scheme, target_str):
+    '''
+    Returns the set of all targets target_str depends on, including itself.
+    '''
+    result = set([target_str])
+    stack = [target_str]
+    while len(stack) > 0:
+        for d in scheme.get_dependencies(stack.pop()) or []:
+            if d not in result:
+                result.add(d)
+                stack.append(d)
+    return result
+
+def critical_path(scheme, durations, targets):
+    '''
+    Returns the path (list of targets, last one from targets) with the largest total duration
+    through the dependency graph, together with that duration.
+    durations maps targets to durations, missing targets take no time.
+    '''
+    finish = dict()   # target -> (total duration of the longest path ending in it, previous target on it)
+    for t in targets:
+        stack = [t]
+        while len(stack) > 0:
+            c = stack[-1]
+            if c in finish:
+                stack.pop()
+                continue
+            deps = scheme.get_dependencies(c) or []
+            pending = [d for d in deps if d not in finish]
+            if len(pending) > 0:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            best = max([(finish[d][0], d) for d in deps]) if len(deps) > 0 else (0.0, None)
+            finish[c] = (best[0] + durations.get(c, 0.0), best[1])
+    if len(targets) == 0:
+        return ([], 0.0)
+    (total, last) = max([(finish[t][0], t) for t in targets])
+    path = []
+    while last is not None:
+        path.append(last)
+        last = finish[last][1]
+    path.reverse()
+    return (path, total)
+
+def print_profile(scheme, target_str=None, count=20):
+    '''
+    Prints the slowest targets, the time spent per function and the critical path, either for
+    the dependencies of target_str or for all targets with recorded metrics.
+    '''
+    metrics = read_metrics(scheme)
+    if target_str is not None:
+        closure = dependency_closure(scheme, target_str)
+        metrics = dict([(t, m) for (t, m) in metrics.iteritems() if t in closure])
+    if len(metrics) == 0:
+        print "No metrics recorded"
+        return
+    print "Slowest targets:"
+    print "%10s %10s %10s %12s %12s  %s" % ("wall, s", "cpu, s", "rss, KB", "read", "written", "target")
+    for m in sorted(metrics.itervalues(), key=lambda m: -m['wall'])[:count]:
+        print "%10.3f %s %s %s %s  %s" % (m['wall'], format_metric(m['cpu'], "%10.3f", 10), format_metric(m['maxrss'], "%10d", 10),
+                                          format_metric(m['read_bytes'], "%12d", 12), format_metric(m['write_bytes'], "%12d", 12), m['target'])
+
+    per_function = dict()
+    for m in metrics.itervalues():
+        (n, wall, cpu) = per_function.get(m['function'], (0, 0.0, 0.0))
+        per_function[m['function']] = (n + 1, wall + m['wall'], cpu + (m['cpu'] or 0.0))
+    print
+    print "Time per function:"
+    print "%10s %10s %8s  %s" % ("wall, s", "cpu, s", "targets", "function")
+    for (name, (n, wall, cpu)) in sorted(per_function.iteritems(), key=lambda x: -x[1][1]):
+        print "%10.3f %10.3f %8d  %s" % (wall, cpu, n, name)
+
+    durations = dict([(t, m['wall']) for (t, m) in metrics.iteritems()])
+    (path, total) = critical_path(scheme, durations, [target_str] if target_str is not None else sorted(metrics))
+    print
+    print "Critical path (%.3f s):" % total
+    for t in path:
+        print "%10.3f  %s" % (durations.get(t, 0.0), t)
+
+class DurationEstimates:
+    '''
+    Estimates the durations of computations from the recorded metrics: the last successful
+    duration of the target itself, otherwise the mean duration of its function, otherwise the
+    mean duration of all recorded computations (or default, if nothing is recorded).
+    '''
+    def __init__(self, scheme, default=1.0):
+        self.scheme = scheme
+        self.targets = dict()
+        self.functions = dict()     # function -> [total duration, number of computations]
+        self.total = 0.0            # of the durations in self.targets
+        self.default = default
+        for m in read_metrics(scheme).itervalues():
+            if m['result'] == 0:
+                self.record(m['target'], m['function'], m['wall'])
+
+    def record(self, target_str, function_name, wall):
+        '''
+        Takes into account a successful computation, e.g. one finished after the estimates were read.
+        '''
+        self.total = self.total + wall - self.targets.get(target_str, 0.0)
+        self.targets[target_str] = wall
+        total = self.functions.setdefault(function_name, [0.0, 0])
+        total[0] = total[0] + wall
+        total[1] = total[1] + 1
+
+    def function_estimate(self, function_name):
+        if function_name in self.functions:
+            return self.functions[function_name][0] / self.functions[function_name][1]
+        elif len(self.targets) > 0:
+            return self.total / len(self.targets)
+        return self.default
+
+    def estimate(self, target_str):
+        if target_str in self.targets:
+            return self.targets[target_str]
+        inv = self.scheme.find_invocation_for_target(target_str)
+        return self.function_estimate(inv[1].name if inv is not None else None)
+
+def remaining_path_lengths(scheme, targets, estimates):
+    '''
+    For each of the given targets returns the estimated duration of the longest path starting with it,
+    following the dependents within targets. Computing the targets with the longest remaining paths
+    first shortens the total time of a parallel computation.
+    targets - set of targets, estimates - DurationEstimates.
+    '''
+    dependents = dict()
+    for t in targets:
+        for d in scheme.get_dependencies(t) or []:
+            if d in targets:
+                dependents.setdefault(d, []).append(t)
+    result = dict()
+    for t in targets:
+        stack = [t]
+        while len(stack) > 0:
+            c = stack[-1]
+            if c in result:
+                stack.pop()
+                continue
+            pending = [p for p in dependents.get(c, []) if p not in result]
+            if len(pending) > 0:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            result[c] = estimates.estimate(c) + max([0.0] + [result[p] for p in dependents.get(c, [])])
+    return result
+
+def critical_path_priorities(scheme, final_target_str, status=None, estimates=None):
+    '''
+    Returns remaining_path_lengths for all targets which are needed for final_target_str and are not done.
+    status - object providing target_status(target_str), the scheme itself by default.
+    '''
+    if status is None:
+        status = scheme
+    if estimates is None:
+        estimates = DurationEstimates(scheme)
+    pending = set([final_target_str])
+    stack = [final_target_str]
+    while len(stack) > 0:
+        for d in scheme.get_dependencies(stack.pop()) or []:
+            if d not in pending and status.target_status(d) != TARGET_STATUS_DONE:
+                pending.add(d)
+                stack.append(d)
+    return remaining_path_lengths(scheme, pending, estimates)
@@ -6,9 +6,14 @@ Copyright 2010, Konstantin Tretyakov.
 Licensed under the BSD (3-clause) license.
 '''
 
-import sys, optparse, traceback
+import sys, os, optparse, traceback
 from runner import *
 from computation import *
+from compiled import compiled_scheme_filename, save_compiled_scheme, load_compiled_scheme, remove_superseded_schemes
+from collector import GarbageCollector, collect_garbage, use_dependencies, restore_output, parse_size
+from resources import ResourceLedger, FileResourceLedger, machine_resources, target_resources
+from telemetry import start_measurement, finish_measurement, record_metrics, print_profile, \
+                      DurationEstimates, remaining_path_lengths, critical_path_priorities
 
 # -------------- Utility functions -----------------
 def print_dependency_list(scheme, target_str):
@@ -16,15 +21,17 @@ def print_dependency_list(scheme, target_str):
     while len(cur) > 0:
         (c, l) = cur.pop()
         print "%s%s" % (" "*l, c)
-        deps = scheme.dependency_graph.get(c, None)
+        deps = scheme.get_dependencies(c)
         if deps is None:
             print "%s%s" % (" "*(l+1), "??")
         else:
-            for k in scheme.dependency_graph[c]:
+            for k in deps:
                 cur.append( (k, l+1) )
 
 def print_dependencytodo_list(scheme, target_str):
     targets_mentioned = set()
+    snapshot = scheme.status_snapshot()
+    ready = set(scheme.find_ready_targets(target_str, snapshot))
     cur = [(target_str,0)]
     while len(cur) > 0:
         (c, l) = cur.pop()
@@ -32,44 +39,48 @@ def print_dependencytodo_list(scheme, target_str):
             continue
         targets_mentioned.add(c)
 
-        if scheme.is_locked(c):
+        status = snapshot.target_status(c)
+        if status == TARGET_STATUS_LOCKED:
             stat = "LOCKED"
-        elif scheme.is_done(c):
+        elif status == TARGET_STATUS_DONE:
             stat = "DONE  "
+        elif c in ready:
+            stat = "READY "
         else:
             stat = "      "
         print "%s\t%s%s" % (stat," "*l, c)
-        deps = scheme.dependency_graph.get(c, None)
+        deps = scheme.get_dependencies(c)
         if deps is None:
             print "No deps for %s" % c
             print "%s%s" % (" "*(l+1), "??")
         else:
-            for k in scheme.dependency_graph[c]:
+            for k in deps:
                 cur.append( (k, l+1) )
 
 def print_files_list(scheme):
-    for (a, b) in scheme.all_invocations:
-        print scheme.target_filename(a)
+    for t in scheme.iter_targets():
+        print scheme.target_filename(t)
 
 def print_target_list(scheme):
-    for (a, b) in scheme.all_invocations:
-        print str(a)
+    for t in scheme.iter_targets():
+        print t
 
 def print_target_list_with_stats(scheme):
     total = locked = done = not_done = 0
-    for (a, b) in scheme.all_invocations:
+    snapshot = scheme.status_snapshot()
+    for target_str in scheme.iter_targets():
         stat = "      "
-        target_str = str(a)
         total = total + 1
-        if scheme.is_locked(target_str):
+        status = snapshot.target_status(target_str)
+        if status == TARGET_STATUS_LOCKED:
             stat = "LOCKED"
             locked = locked + 1
-        elif scheme.is_done(target_str):
+        elif status == TARGET_STATUS_DONE:
             stat = "DONE  "
             done = done + 1
         else:
             not_done = not_done + 1
-        print "%s\t%s" % (stat, str(a)) #, scheme.target_filename(str(a)))
+        print "%s\t%s" % (stat, target_str) #, scheme.target_filename(target_str))
     print "----------------"
     print "Not done: %d" % not_done
     print "Locked:    %d" % locked
@@ -82,6 +93,56 @@ def print_target_filename(scheme, target_name):
     else:
         print scheme.target_filename(target_name)
 
+def migrate_cache_layout(scheme, old_layout=None):
+    '''
+    Moves the outputs of all targets from their location under old_layout (FlatLayout by default)
+    to their location under the layout of the scheme, together with their compressed copies (see collector.py).
+    Locked targets are skipped.
+    '''
+    if old_layout is None:
+        old_layout = FlatLayout()
+    present = old_layout.list_cache(scheme.cache_dir)
+    moved = skipped = 0
+    for target_str in scheme.iter_targets():
+        old_name = old_layout.cache_name(target_str)
+        names = [n for n in [old_name, old_name + COMPRESSED_SUFFIX] if n in present]
+        if len(names) == 0 or old_name == scheme.target_cache_name(target_str):
+            continue
+        if old_name + ".locked" in present or not scheme.lock_target(target_str):
+            print "Target locked, not moved: %s" % target_str
+            skipped = skipped + 1
+            continue
+        try:
+            for n in names:
+                os.rename(os.path.join(scheme.cache_dir, n), scheme.target_filename(target_str) + n[len(old_name):])
+            moved = moved + 1
+        finally:
+            scheme.unlock_target(target_str)
+    if hasattr(scheme.layout, 'write_index'):
+        scheme.layout.write_index(scheme.cache_dir, scheme.iter_targets())
+    print "Moved: %d" % moved
+    print "Skipped: %d" % skipped
+
+def print_outdated_targets(scheme, target_str=None, invalidate=False):
+    '''
+    Lists the outdated targets (see find_outdated_targets). With invalidate, their outputs are removed,
+    so that they (and only they) are recomputed by the next run, stepto or make.
+    Locked targets are not removed.
+    '''
+    outdated = scheme.find_outdated_targets(target_str)
+    for t in outdated:
+        if not invalidate:
+            print t
+        elif scheme.lock_target(t):
+            try:
+                scheme.remove_target(t)
+                print "Invalidated: %s" % t
+            finally:
+                scheme.unlock_target(t)
+        else:
+            print "Target locked, not invalidated: %s" % t
+    print "Outdated targets: %d" % len(outdated)
+
 # -------------- Function for invoking the computation of a given target -----------------
 # Possible return values for the next two functions
 STEP_RUN_OK = 0
@@ -95,26 +156,60 @@ COMPUTE_TARGET_RESULT_MSG = ["Step successful", "Step run failed", \
                        "Step run failed with exception", "Target not found",\
                        "Target locked", "Target ready, nothing to be done",\
                        "No steps available"]
-def compute_target(scheme, computation_runner, target_str):
+def compute_target(scheme, computation_runner, target_str, keep_in_memory=False, threaded=False):
     '''
     Invokes the computation registered for creating a given target.
     The computation is invoked even if the target file already exists.
     The computation is NOT invoked, if the target is locked, though.
     The target is locked for the duration of the computation.
+    If the scheme shares computations, an equivalent target which is already done is
+    reused instead, and after a successful computation the output is shared with all
+    equivalent targets which are not done yet.
+    The resources used by the computation are recorded in the metrics file (see telemetry.py).
+    A result the runner keeps in memory (see ResultStore) is written to its file before the target is unlocked,
+    unless keep_in_memory is set: only a caller which flushes the results later itself (see run_to_target) may set it.
+    threaded tells that the computation runs in a thread concurrently with others, so that only its wall time is measured.
     '''
     if not scheme.target_exists(target_str):
         return TARGET_NOT_FOUND
-    if scheme.is_locked(target_str):
+    if not scheme.lock_target(target_str):
         return TARGET_LOCKED
 
-    scheme.lock_target(target_str)
+    result = STEP_RUN_FAILED_WITH_EXCEPTION
+    measurement = None
     try:
+        equivalent = scheme.find_equivalent_targets(target_str)
+        done_equivalent = [t for t in equivalent if scheme.is_done(t)]
+        if len(done_equivalent) > 0:
+            # An output compressed by the collector is restored to be shared
+            restore_output(scheme, done_equivalent[0])
+            scheme.share_output(done_equivalent[0], target_str)
+            result = STEP_RUN_OK
+            print "Target shared with %s: %s" % (done_equivalent[0], target_str)
+            sys.stdout.flush()
+            return result
+
         print "Computing target: %s..." % target_str
         sys.stdout.flush()
+        use_dependencies(scheme, target_str)
         (obj, comp) = scheme.find_invocation_for_target(target_str)
+        measurement = start_measurement()
+        # An output shared by hard links must not be overwritten in place
+        if len(equivalent) > 0:
+            scheme.remove_target(target_str)
         if computation_runner.compute_target(scheme, obj, comp):
+            if not keep_in_memory and hasattr(computation_runner, 'persist_result'):
+                computation_runner.persist_result(target_str)
             result = STEP_RUN_OK
             print "Target successful: %s" % target_str
+            # (Results kept in memory by the runner can not be shared)
+            for t in equivalent if os.path.exists(scheme.target_filename(target_str)) else []:
+                if scheme.lock_target(t):
+                    try:
+                        if not os.path.exists(scheme.target_filename(t)):
+                            scheme.share_output(target_str, t)
+                    finally:
+                        scheme.unlock_target(t, True)
         else:
             result = STEP_RUN_FAILED
             print "Target failed: %s" % target_str
@@ -127,7 +222,130 @@ def compute_target(scheme, computation_runner, target_str):
         sys.stdout.flush()
         scheme.remove_target(target_str)
     finally:
-        scheme.unlock_target(target_str)
+        if measurement is not None:
+            try:
+                record_metrics(scheme, finish_measurement(measurement, scheme, target_str, comp.name, result, threaded))
+            except:
+                traceback.print_exc()
+        scheme.unlock_target(target_str, result == STEP_RUN_OK)
+    return result
+
+def compute_target_batch(scheme, computation_runner, target_strs, keep_in_memory=False):
+    '''
+    Computes targets with equal batch keys with a single call of the runner's compute_batch
+    (see PythonFunctionRunner.compute_batch). Each target is locked, unlocked and written out as in compute_target.
+    Returns the list of the results (as of compute_target) for the targets.
+    '''
+    results = dict()
+    locked = []
+    for t in target_strs:
+        if not scheme.target_exists(t):
+            results[t] = TARGET_NOT_FOUND
+        elif not scheme.lock_target(t):
+            results[t] = TARGET_LOCKED
+        else:
+            locked.append(t)
+
+    result = STEP_RUN_FAILED_WITH_EXCEPTION
+    measurement = None
+    try:
+        if len(locked) > 0:
+            print "Computing targets: %s..." % ", ".join(locked)
+            sys.stdout.flush()
+            for t in locked:
+                use_dependencies(scheme, t)
+            invocations = [scheme.find_invocation_for_target(t) for t in locked]
+            measurement = start_measurement()
+            if computation_runner.compute_batch(scheme, invocations):
+                if not keep_in_memory and hasattr(computation_runner, 'persist_result'):
+                    for t in locked:
+                        computation_runner.persist_result(t)
+                result = STEP_RUN_OK
+                print "Targets successful: %s" % ", ".join(locked)
+            else:
+                result = STEP_RUN_FAILED
+                print "Targets failed: %s" % ", ".join(locked)
+                for t in locked:
+                    scheme.remove_target(t)
+            sys.stdout.flush()
+    except:
+        traceback.print_exc()
+        result = STEP_RUN_FAILED_WITH_EXCEPTION
+        print "Targets failed with exception: %s" % ", ".join(locked)
+        sys.stdout.flush()
+        for t in locked:
+            scheme.remove_target(t)
+    finally:
+        for t in locked:
+            if measurement is not None:
+                try:
+                    record = finish_measurement(measurement, scheme, t, invocations[0][1].name, result)
+                    # The resources are divided equally among the targets of the batch
+                    for k in ['wall', 'cpu', 'read_bytes', 'write_bytes']:
+                        record[k] = record[k] / len(locked)
+                    record['batch'] = len(locked)
+                    record_metrics(scheme, record)
+                except:
+                    traceback.print_exc()
+            scheme.unlock_target(t, result == STEP_RUN_OK)
+            results[t] = result
+    return [results[t] for t in target_strs]
+
+def compute_targets(scheme, computation_runner, target_strs, keep_in_memory=False):
+    '''
+    Computes the given targets one after another in the current process, each using compute_target.
+    A target depending on one of the preceding targets which could not be computed is skipped.
+    If the runner supports batches (see PythonFunctionRunner.batch_key), the targets which do not depend
+    on the other given targets are first grouped by their batch keys, and each group is computed
+    with a single call (see compute_target_batch). This is not done for schemes sharing computations.
+    keep_in_memory is passed to compute_target.
+    Returns the list of the results of compute_target, with None for the skipped targets.
+    '''
+    computed = dict()
+    batch_key = getattr(computation_runner, 'batch_key', None)
+    if batch_key is not None and not scheme.share_computations:
+        given = set(target_strs)
+        groups = dict()
+        for t in target_strs:
+            inv = scheme.find_invocation_for_target(t)
+            if inv is None or len(given.intersection(scheme.get_dependencies(t))) > 0:
+                continue
+            try:
+                key = batch_key(t, inv[1])
+            except:
+                key = None      # E.g. an unknown serializer, reported when the target is computed
+            if key is not None:
+                groups.setdefault(key, []).append(t)
+        for group in groups.itervalues():
+            if len(group) > 1:
+                computed.update(zip(group, compute_target_batch(scheme, computation_runner, group, keep_in_memory)))
+
+    results = []
+    unavailable = set()
+    for t in target_strs:
+        if t in computed:
+            result = computed[t]
+        elif len(unavailable.intersection(scheme.get_dependencies(t) or [])) > 0:
+            print "Target skipped, its dependency was not computed: %s" % t
+            result = None
+        else:
+            result = compute_target(scheme, computation_runner, t, keep_in_memory)
+        if result != STEP_RUN_OK:
+            unavailable.add(t)
+        results.append(result)
+    return results
+
+def targets_to_compute(scheme, target_strs):
+    '''
+    Returns those of the given targets which are not done, are outdated (see find_outdated_targets)
+    or depend on one of the returned ones. make runs the rule of a batch (see save_makefile) when any of
+    its targets is missing or outdated, the others are not recomputed by the "computebatch" action.
+    '''
+    outdated = set(scheme.find_outdated_targets(list(target_strs)))
+    result = []
+    for t in target_strs:
+        if not scheme.is_done(t) or t in outdated or len(set(result).intersection(scheme.get_dependencies(t) or [])) > 0:
+            result.append(t)
     return result
 
 def view_compute_target(scheme, computation_runner, target_str):
@@ -144,39 +362,57 @@ def view_compute_target(scheme, computation_runner, target_str):
 
 # -------------- Main computing function -----------------
 
-def do_step_to_target(scheme, computation_runner, final_target_str):
+def find_next_targets(scheme, final_target_str, snapshot, critical_path=False, first_only=False):
+    '''
+    Returns the targets which can be computed right now on the way to final_target_str (see find_ready_targets).
+    With critical_path, they are ordered by decreasing estimated length of the remaining path
+    (see telemetry.critical_path_priorities), otherwise in depth-first order.
+    '''
+    if not critical_path:
+        return scheme.find_ready_targets(final_target_str, snapshot, first_only=first_only)
+    ready = scheme.find_ready_targets(final_target_str, snapshot)
+    priorities = critical_path_priorities(scheme, final_target_str, snapshot)
+    ready.sort(key=lambda t: -priorities.get(t, 0.0))
+    return ready
+
+def do_step_to_target(scheme, computation_runner, final_target_str, critical_path=False):
     # Is there such a target at all?
     if not scheme.target_exists(final_target_str):
         return TARGET_NOT_FOUND
     # Is target ready?
-    if scheme.is_done(final_target_str):
+    snapshot = scheme.status_snapshot()
+    if snapshot.is_done(final_target_str):
         return TARGET_READY
     # Is there some next step to do?
-    next_target = scheme.find_next_step_to(final_target_str)
-    if next_target is None:
+    ready = find_next_targets(scheme, final_target_str, snapshot, critical_path, first_only=True)
+    if len(ready) == 0:
         return NO_STEPS_AVAILABLE
+    next_target = ready[0]
     # Else, lock target and invoke the step
     return compute_target(scheme, computation_runner, next_target)
 
-def view_step_to_target(scheme, computation_runner, final_target_str):
+def view_step_to_target(scheme, computation_runner, final_target_str, critical_path=False):
     # Is there such a target at all?
     if not scheme.target_exists(final_target_str):
         print "Target %s does not exist" % final_target_str
         return TARGET_NOT_FOUND
     # Is target ready?
-    if scheme.is_done(final_target_str):
+    snapshot = scheme.status_snapshot()
+    if snapshot.is_done(final_target_str):
         print "Target %s is already done. Nothing to be made." % final_target_str
         return TARGET_READY
     # Is there some next step to do?
-    next_target = scheme.find_next_step_to(final_target_str)
-    if next_target is None:
+    ready = find_next_targets(scheme, final_target_str, snapshot, critical_path)
+    if len(ready) == 0:
         print "No next steps are available either because all matching targets " + \
               "are locked and being built or because one of the intermediate steps is not specified."
         return NO_STEPS_AVAILABLE
+    next_target = ready[0]
 
     (obj, comp) = scheme.find_invocation_for_target(next_target)
     result = computation_runner.describe_compute_target(scheme, obj, comp)
     print "Next target: %s\nBuild spec: %s" % (next_target, result)
+    print "Targets that can be computed right now: %d" % len(ready)
     return STEP_RUN_OK
 
 # ----------------- Standard cmdarg parser ----------------------- #
@@ -200,9 +436,18 @@ def pycex_parse_cmdline(version="1.0"):
     * viewstepto [target]
         just tells what would be the next computation to do,
 
+    * run [target]
+        performs all the computations needed to reach target, running up to
+        -j <n> of them in parallel (and up to --io-jobs <n> I/O-bound ones in threads).
+        With --collect or --quota <size>, intermediate outputs are collected as with "gc" meanwhile,
+
     * compute [target]
         invokes the computation assigned to build target,
 
+    * computebatch [target ...]
+        invokes the computations of several targets one after another in a single process,
+        skipping those which are done and up to date (see targets_to_compute),
+
     * viewcompute [target]
         just tells what is the computation needed to build target,
 
@@ -211,6 +456,28 @@ def pycex_parse_cmdline(version="1.0"):
         The [python-command] argument must be a command you use to invoke this script.
         For example: "python script.py". The whole command would then be something like
         $ python script.py makefile "python script.py",
+        With --socket <path>, the rules compute targets through the server started with "serve",
+        and [python-command] may be omitted (--batch, --resources, --memory and --cores can not be used then).
+        With --collect, make does not recompute the outputs collected by "gc" (see collector.py) while
+        the targets depending on them are up to date,
+
+    * ninja [python-command]
+        outputs a build.ninja file for the ninja build tool, which works as "makefile" but
+        is much faster for large schemes. --socket is supported as for "makefile", with
+        --pool <function>=<n> at most n computations of the function run at the same time,
+        with --restat targets are not recomputed when their dependencies are recomputed without changes,
+
+    * serve [socket]
+        starts a server which keeps the scheme and the imported functions in memory and
+        computes targets requested through the given Unix socket in forked workers,
+
+    * coordinator [target]
+        hands out the computations needed to reach target to the workers connecting to
+        --listen <host:port> over TCP (see distributed.py). With --speculate <factor>, targets running
+        factor times longer than usual for their function are also handed out to a second worker,
+
+    * worker
+        computes the targets handed out by the coordinator at --connect <host:port>,
 
     * list
         lists all targets,
@@ -219,24 +486,120 @@ def pycex_parse_cmdline(version="1.0"):
         lists all targets with information about them being ready or locked,
 
     * listfiles
-        lists all output files correspondign to the results.
+        lists all output files correspondign to the results,
+
+    * profile [target]
+        reports the slowest targets, the time spent per function and the critical path
+        among the recorded computations (of all targets or of the dependencies of target),
+
+    * outdated [target]
+        lists the targets (of all targets or of the dependencies of target) whose outputs are older
+        than those of their dependencies, or which depend on such targets. With --invalidate,
+        their outputs are removed, so that only they are recomputed,
+
+    * gc [target]
+        removes the outputs of the intermediate targets (of all targets or of the dependencies
+        of target) whose dependents are all done (see collector.py). With --compress, the outputs are
+        compressed instead, with --quota <size>, only as many are collected as needed to fit the cache
+        into the quota, least recently used first,
+
+    * migratecache
+        moves the outputs stored in a flat cache directory to the layout
+        configured for the scheme (e.g. ShardedLayout).
     """
 
     parser = optparse.OptionParser(usage=USAGE + "\n\n" + SYNOPSIS, version=VERSION, description="", formatter=optparse.TitledHelpFormatter())
+    parser.add_option("-j", "--jobs", type="int", dest="jobs", default=1, help="number of parallel computations for the run action")
+    parser.add_option("-s", "--socket", dest="socket", default=None, help="socket of the server to be used by the makefile rules")
+    parser.add_option("--listen", dest="listen", default="localhost", metavar="HOST:PORT",
+                      help="address the coordinator listens on (the default port is 7450)")
+    parser.add_option("--connect", dest="connect", default=None, metavar="HOST:PORT", help="address of the coordinator for the worker action")
+    parser.add_option("--lease", type="float", dest="lease", default=30.0,
+                      help="for the coordinator action: seconds after which a target is handed out again if its worker does not report")
+    parser.add_option("--speculate", type="float", dest="speculate", default=None, metavar="FACTOR",
+                      help="for the coordinator action: compute a target once more when it runs FACTOR times longer than "
+                           "the recorded computations of its function")
+    parser.add_option("-P", "--pool", action="append", dest="pools", default=[], metavar="FUNCTION=N",
+                      help="for the ninja action: run at most N computations of the function at the same time")
+    parser.add_option("--invalidate", action="store_true", dest="invalidate", default=False,
+                      help="for the outdated action: remove the outputs of the outdated targets")
+    parser.add_option("--restat", action="store_true", dest="restat", default=False,
+                      help="for the ninja action: do not recompute targets depending on outputs that did not change")
+    parser.add_option("--io-jobs", type="int", dest="io_jobs", default=0,
+                      help="for the run action: number of I/O-bound computations (see AsyncFunctionRunner) run in threads at the same time")
+    parser.add_option("-b", "--batch", type="choice", choices=["function", "chain"], dest="batch", default=None,
+                      help="for run, makefile and ninja: compute small targets in batches, grouped by function or by chain")
+    parser.add_option("--batch-size", type="int", dest="batch_size", default=10, help="maximal number of targets in a batch")
+    parser.add_option("-r", "--resources", action="store_true", dest="resources", default=False,
+                      help="for run, compute, computebatch, makefile and ninja: start computations only when the resources "
+                           "they declare (see resources.py) are available")
+    parser.add_option("--memory", type="float", dest="memory", default=None, help="memory available for --resources, in GB (default: all)")
+    parser.add_option("--cores", type="int", dest="cores", default=None, help="cores available for --resources (default: all)")
+    parser.add_option("--quota", dest="quota", default=None, metavar="SIZE",
+                      help="for gc and run: size limit of the cache directory, e.g. 500M or 20G")
+    parser.add_option("--compress", action="store_true", dest="compress", default=False,
+                      help="for gc and run: compress intermediate outputs instead of removing them")
+    parser.add_option("--collect", action="store_true", dest="collect", default=False,
+                      help="for run: collect intermediate outputs as soon as all their dependents are done, "
+                           "for makefile: do not recompute collected outputs while the targets depending on them are up to date")
+    parser.add_option("--pin", action="append", dest="pinned", default=[], metavar="TARGET",
+                      help="for gc and run: never collect the output of the target")
+    parser.add_option("-c", "--critical-path", action="store_true", dest="critical_path", default=False,
+                      help="for stepto, viewstepto, run and makefile: compute first the targets on the longest remaining paths, "
+                           "estimated from the recorded durations")
     (options, args) = parser.parse_args()
     if len(args) == 0:
         parser.print_help()
         sys.exit(2)
-    elif args[0] in ["dependency", "dependencystat", "stepto", "viewstepto", "viewcompute", "targetfile", "compute", "makefile"]:
-        if len(args) < 2:
+    elif args[0] in ["dependency", "dependencystat", "stepto", "viewstepto", "viewcompute", "targetfile", "compute", "makefile", "ninja", "run", "serve", "coordinator"]:
+        if len(args) < 2 and not (args[0] in ["makefile", "ninja"] and options.socket is not None):
             parser.error("Parameter expected")
         elif len(args) > 2:
             parser.error("Too many parameters")
-    elif args[0] in ["list", "stat", "listfiles"]:
+    elif args[0] in ["list", "stat", "listfiles", "migratecache", "worker"]:
         if len(args) != 1:
             parser.error("Too many arguments")
+    elif args[0] in ["computebatch"]:
+        if len(args) < 2:
+            parser.error("Parameter expected")
+    elif args[0] in ["profile", "outdated", "gc"]:
+        if len(args) > 2:
+            parser.error("Too many parameters")
     else:
         parser.error("Invalid arguments")
+    if options.jobs < 1:
+        parser.error("The number of jobs must be positive")
+    if options.io_jobs < 0:
+        parser.error("The number of I/O jobs must not be negative")
+    if args[0] == "worker" and options.connect is None:
+        parser.error("The address of the coordinator (--connect) is required")
+    if options.lease <= 0:
+        parser.error("The lease must be positive")
+    if options.speculate is not None and options.speculate <= 1:
+        parser.error("The speculation factor must be greater than 1")
+    if options.batch_size < 1:
+        parser.error("The batch size must be positive")
+    if options.batch is not None and options.socket is not None and args[0] in ["makefile", "ninja"]:
+        parser.error("Batches can not be computed through the server")
+    if (options.resources or options.memory is not None or options.cores is not None) and options.socket is not None and args[0] in ["makefile", "ninja"]:
+        parser.error("Resources can not be managed for the server")
+    if options.quota is not None:
+        try:
+            options.quota = parse_size(options.quota)
+        except Exception, e:
+            parser.error(str(e))
+    options.capacity = machine_resources()
+    if options.memory is not None:
+        options.capacity['memory'] = options.memory
+    if options.cores is not None:
+        options.capacity['cores'] = options.cores
+    pools = dict()
+    for p in options.pools:
+        (name, sep, depth) = p.rpartition('=')
+        if not sep or not depth.isdigit() or int(depth) < 1:
+            parser.error("Invalid pool: %s" % p)
+        pools[name] = int(depth)
+    options.pools = pools
 
     return (options, args)
 
@@ -246,11 +609,71 @@ def pycex_default_main(scheme, runner, version="1.0"):
     def main():
         (options, args) = pycex_parse_cmdline(version)
         arg = args[0]
+        batches = None
+        if arg in ["makefile", "ninja"] and options.batch is not None:
+            batches = scheme.group_targets(options.batch, options.batch_size)
+        ledger = None
+        if options.resources and arg in ["compute", "computebatch"]:
+            ledger = FileResourceLedger(scheme, options.capacity)
+        if options.resources and arg in ["makefile", "ninja"]:
+            # The computations started by make wait for the resources themselves
+            args[1] = args[1] + " --resources"
+            if options.memory is not None:
+                args[1] = args[1] + " --memory %s" % options.memory
+            if options.cores is not None:
+                args[1] = args[1] + " --cores %d" % options.cores
         if arg == "makefile":
-            scheme.save_makefile(args[1] + " compute")
+            priorities = None
+            if options.critical_path:
+                priorities = remaining_path_lengths(scheme, set(scheme.iter_targets()), DurationEstimates(scheme))
+            if options.socket is not None:
+                from server import client_command
+                scheme.save_makefile(client_command(options.socket), priorities=priorities, secondary=options.collect)
+            else:
+                scheme.save_makefile(args[1] + " compute", priorities=priorities, batches=batches, batch_command=args[1] + " computebatch",
+                                     secondary=options.collect)
+        elif arg == "ninja":
+            if options.socket is not None:
+                from server import client_command
+                scheme.save_ninja(client_command(options.socket), pools=options.pools, restat=options.restat)
+            else:
+                scheme.save_ninja(args[1] + " compute", pools=options.pools, restat=options.restat,
+                                  batches=batches, batch_command=args[1] + " computebatch")
+        elif arg == "serve":
+            from server import serve
+            serve(scheme, runner, args[1])
+        elif arg == "coordinator":
+            from distributed import coordinate
+            result = coordinate(scheme, args[1], options.listen, options.lease, options.critical_path, options.speculate)
+            print "Result: " + COMPUTE_TARGET_RESULT_MSG[result]
+        elif arg == "worker":
+            from distributed import work
+            work(scheme, runner, options.connect)
         elif arg == "compute":
-            result = compute_target(scheme, runner, args[1])
+            if ledger is not None:
+                ledger.acquire(args[1], target_resources(scheme, args[1]))
+            try:
+                result = compute_target(scheme, runner, args[1])
+            finally:
+                if ledger is not None:
+                    ledger.release(args[1])
             print "Result: " + COMPUTE_TARGET_RESULT_MSG[result]
+        elif arg == "computebatch":
+            todo = targets_to_compute(scheme, args[1:])
+            results = dict([(t, TARGET_READY) for t in args[1:]])
+            if len(todo) > 0:
+                if ledger is not None:
+                    # The targets are computed one after another (or together), so the batch needs what the most demanding one needs
+                    needs = [target_resources(scheme, t) for t in todo]
+                    ledger.acquire(todo[0], dict([(k, max([n.get(k, 0) for n in needs])) for k in options.capacity]))
+                try:
+                    results.update(zip(todo, compute_targets(scheme, runner, todo)))
+                finally:
+                    if ledger is not None:
+                        ledger.release(todo[0])
+            for t in args[1:]:
+                result = results[t]
+                print "%s: %s" % (t, COMPUTE_TARGET_RESULT_MSG[result] if result is not None else "Skipped")
         elif arg == "viewcompute":
             result = view_compute_target(scheme, runner, args[1])
         elif arg == "list":
@@ -259,15 +682,32 @@ def pycex_default_main(scheme, runner, version="1.0"):
             print_target_list_with_stats(scheme)
         elif arg == "listfiles":
             print_files_list(scheme)
+        elif arg == "migratecache":
+            migrate_cache_layout(scheme)
+        elif arg == "outdated":
+            print_outdated_targets(scheme, args[1] if len(args) > 1 else None, options.invalidate)
+        elif arg == "gc":
+            collected = collect_garbage(scheme, args[1] if len(args) > 1 else None, options.quota, options.compress, options.pinned)
+            print "Collected %d outputs" % len(collected)
+        elif arg == "profile":
+            print_profile(scheme, args[1] if len(args) > 1 else None)
         elif arg == "dependency":
             print_dependency_list(scheme, args[1])
         elif arg == "dependencystat":
             print_dependencytodo_list(scheme, args[1])
         elif arg == "stepto":
-            result = do_step_to_target(scheme, runner, args[1])
+            result = do_step_to_target(scheme, runner, args[1], options.critical_path)
+            print "Result: " + COMPUTE_TARGET_RESULT_MSG[result]
+        elif arg == "run":
+            from executor import run_to_target
+            collector = None
+            if options.collect or options.quota is not None:
+                collector = GarbageCollector(scheme, options.quota, options.compress, options.pinned + [args[1]], runner)
+            result = run_to_target(scheme, runner, args[1], options.jobs, options.critical_path, options.batch, options.batch_size, options.io_jobs,
+                                   ResourceLedger(options.capacity) if options.resources else None, collector)
             print "Result: " + COMPUTE_TARGET_RESULT_MSG[result]
         elif arg == "viewstepto":
-            result = view_step_to_target(scheme, runner, args[1])
+            result = view_step_to_target(scheme, runner, args[1], options.critical_path)
         elif arg == "targetfile":
             print_target_filename(scheme, args[1])
         else:
@@ -278,16 +718,30 @@ def pycex_default_main(scheme, runner, version="1.0"):
 
 # ----------------- Standard annotation-style definition ----------------------- #
 # Usage: @pycex_experiment(runner=SYSTEM_RUNNER, cache_dir=CACHE_DIR)
+# (add state_store=SQLiteStateStore() to keep locks in a database instead of .locked files)
 # def specify_experiment(scheme):
 #     .... scheme.data_object.result = scheme.computation.compute(....)
 #
 # if __name__ == "__main__":
 #    specify_experiment()
-def pycex_experiment(runner=SYSTEM_RUNNER, cache_dir='.', version="1.0"):
+#
+# With compile_scheme=True the built scheme is saved in cache_dir and loaded on later invocations instead of
+# running specify_experiment again, until the file containing it is modified or the version or the settings
+# of the scheme are changed. Compiled schemes made unused this way are removed.
+def pycex_experiment(runner=SYSTEM_RUNNER, cache_dir='.', version="1.0", state_store=None, share_computations=False, layout=None, compile_scheme=False):
     def transform_function(original_function):
         def new_function():
-            scheme = ComputationScheme(cache_dir)
-            original_function(scheme)
+            scheme = None
+            if compile_scheme:
+                filename = compiled_scheme_filename(cache_dir, original_function, version, state_store, share_computations, layout)
+                if os.path.exists(filename):
+                    scheme = load_compiled_scheme(filename, cache_dir, state_store, share_computations, layout)
+            if scheme is None:
+                scheme = ComputationScheme(cache_dir, state_store, share_computations, layout)
+                original_function(scheme)
+                if compile_scheme and len(scheme.rules) == 0 and os.path.isdir(cache_dir):
+                    save_compiled_scheme(scheme, filename)
+                    remove_superseded_schemes(cache_dir, original_function, filename)
             main = pycex_default_main(scheme, runner, version)
             main()
         return new_function